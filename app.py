@@ -1,67 +1,212 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 import string
 from flask import Flask, request, render_template, Response, send_file
 from base64 import b64decode, b64encode
-from PIL import Image
 import io
 import json
-from proto_v2 import main, segmentation
+from proto_v2 import assets, caching, complexforms_v2, evaluatablegeneration_v2, image_decode, main, patterns, \
+    prefetch, scorers, segmentation, sessions
 from tensorflow.python.keras.models import load_model
 import time
 import psutil
 import os
 import random
+import threading
 
 
 app = Flask(__name__, static_folder='static')
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
 
-ESTIMATOR = load_model('proto_v2/effnet_model/efficientnetB3_0.77.h5')
-SEG_MODEL = segmentation.DeepLabModel("proto_v2/xception_model")
+# batching is used only for graphs with a dynamic batch dimension, the shipped ones have a batch of one
+SEG_BATCH_WINDOW = 0.02  # seconds to wait for more images before running a segmentation batch
+SEG_MAX_BATCH_SIZE = 8
+SEG_MODEL_PATHS = {'accurate': 'proto_v2/xception_model',
+                   'fast': 'proto_v2/mobile_net_model'}
+SEG_DEFAULT_TIER = 'accurate'
+SEG_FALLBACK_TIER = 'fast'
+SEG_FALLBACK_IN_FLIGHT = 4  # images segmented or waiting for it, None disables falling back to SEG_FALLBACK_TIER
+SEG_MODELS = segmentation.SegmentationBackends(
+    {tier: segmentation.batch_requests(segmentation.DeepLabModel(path), max_batch_size=SEG_MAX_BATCH_SIZE,
+                                       batch_window=SEG_BATCH_WINDOW)
+     for tier, path in SEG_MODEL_PATHS.items()},
+    default=SEG_DEFAULT_TIER, fallback=SEG_FALLBACK_TIER, fallback_in_flight=SEG_FALLBACK_IN_FLIGHT)
+
+MASK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+MASK_CACHE_DIR = 'mask_cache'  # None disables on-disk tier
+MASK_CACHE_MAX_DISK_BYTES = 1024 * 1024 * 1024
+MASK_CACHE = caching.MaskCache(max_bytes=MASK_CACHE_MAX_BYTES, cache_dir=MASK_CACHE_DIR,
+                               max_disk_bytes=MASK_CACHE_MAX_DISK_BYTES)
 
 FORMS_ROOT = 'proto_v2/forms_processed'
 FONTS_ROOT = 'proto_v2/Fonts'
-# SEG_MODEL_PATH = 'proto_v2/mobile_net_model'
+
+complexforms_v2.get_atlas(FORMS_ROOT)  # decode forms once at startup
+assets.get_assets(FORMS_ROOT).preload()
+
+KERAS_ESTIMATOR = load_model('proto_v2/effnet_model/efficientnetB3_0.77.h5')
+SCORER_BACKEND = 'keras'  # 'keras', 'tflite' or 'frozen_graph'
+SCORER_QUANTIZATION = 'float16'  # TFLite export quantization: None, 'float16' or 'int8'
+# every quantization is exported to its own file, so changing SCORER_QUANTIZATION exports a new model
+SCORER_PATHS = {'tflite': f'proto_v2/effnet_model/efficientnetB3_0.77_{SCORER_QUANTIZATION or "float32"}.tflite',
+                'frozen_graph': 'proto_v2/effnet_model/efficientnetB3_0.77_frozen.pb'}
+SCORER_SAMPLES_COUNT = 32  # layouts used for int8 calibration and agreement check
+
+if SCORER_BACKEND == 'keras':
+    ESTIMATOR = scorers.load_scorer(SCORER_BACKEND, KERAS_ESTIMATOR)
+    SCORER_AGREEMENT = None
+else:
+    scorer_samples = evaluatablegeneration_v2.sample_scorer_inputs(FORMS_ROOT, KERAS_ESTIMATOR.input_shape[1: 3],
+                                                                   SCORER_SAMPLES_COUNT)
+    ESTIMATOR = scorers.load_scorer(SCORER_BACKEND, KERAS_ESTIMATOR, SCORER_PATHS[SCORER_BACKEND],
+                                    SCORER_QUANTIZATION, scorer_samples)
+    SCORER_AGREEMENT = scorers.measure_agreement(scorers.KerasScorer(KERAS_ESTIMATOR), ESTIMATOR, scorer_samples)
+    print(f'{SCORER_BACKEND} scorer agreement with keras model: {SCORER_AGREEMENT}')
+
+RENDER_WORKERS = os.cpu_count()  # threads rendering (pattern, crop) jobs of /generate
+RENDER_POOL = ThreadPoolExecutor(max_workers=RENDER_WORKERS)
+
+ANALYSIS_WORKERS = 2  # threads analyzing images uploaded to /api/init
+ANALYSIS_MAX_PENDING = 16  # /api/init responds 503 while this many analyses are not finished
+ANALYSIS_WAIT_TIMEOUT = 10  # seconds /api/getnextimage waits for analysis before responding 202
+ANALYSIS_POOL = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS)
+
+PREFETCH_DEPTH = 2  # images rendered ahead for every token
+PREFETCH_WORKERS = 2
+PREFETCH_MAX_BYTES = 256 * 1024 * 1024
+PREFETCHER = prefetch.Prefetcher(depth=PREFETCH_DEPTH, max_workers=PREFETCH_WORKERS, max_bytes=PREFETCH_MAX_BYTES)
+
+SESSIONS_PATH = 'sessions.sqlite3'  # shared by all worker processes, None keeps sessions in this process only
+SESSIONS_MAX_AGE = 300  # seconds
+SESSIONS_MAX_COUNT = 15
+SESSIONS = sessions.InMemorySessionStore() if SESSIONS_PATH is None else sessions.SQLiteSessionStore(SESSIONS_PATH)
 
 process = psutil.Process(os.getpid())
 
+# state of sessions served by this process, it is rebuilt from SESSIONS for tokens created by other workers
 GENERATORS = dict()
-TOKENS_LIFETIME = dict()
-TOKENS_INDICES = dict()
+ANALYSES = dict()
+PREFETCH_INDICES = dict()
+PREFETCH_LOCKS = dict()  # token -> lock guarding its PREFETCH_INDICES entry and prefetcher buffer
+LOCAL_SESSIONS_LOCK = threading.Lock()
 
 
 def generate_images(img_bytes, estimator, forms_root, fonts_root, seg_model, text):
     generator = main.GenImage(image_bytes=img_bytes, model=estimator, forms_root=forms_root, fonts_root=fonts_root,
-                              seg_model=seg_model, text=text)
+                              seg_model=seg_model, text=text, mask_cache=MASK_CACHE)
 
-    return generator.generate()
+    return generator.generate(executor=RENDER_POOL)
 
 
 def generate_token(length):
     return ''.join(random.choice(string.ascii_letters+string.digits) for _ in range(length))
 
 
+def remove_local_resources(token):
+    GENERATORS.pop(token, None)
+    PREFETCH_INDICES.pop(token, None)
+    PREFETCH_LOCKS.pop(token, None)
+    if token in ANALYSES:
+        ANALYSES.pop(token).cancel()
+    PREFETCHER.remove(token)
+
+
 def remove_token_resources(token):
-    del GENERATORS[token]
-    del TOKENS_LIFETIME[token]
-    del TOKENS_INDICES[token]
+    SESSIONS.remove(token)
+    remove_local_resources(token)
 
     for fn in os.listdir(app.static_folder):
         if token in fn:
             os.remove(os.path.join(app.static_folder, fn))
 
-    del token
-
 
 def prune_tokens():
+    for token in SESSIONS.prune(SESSIONS_MAX_AGE, SESSIONS_MAX_COUNT):
+        remove_token_resources(token)
+    tokens = set(SESSIONS.tokens())
+    for token in list(GENERATORS):
+        if token not in tokens:
+            remove_local_resources(token)
     for fn in os.listdir(app.static_folder):
-        if fn.split('_')[0] not in GENERATORS:
+        if fn.split('_')[0] not in tokens:
             os.remove(os.path.join(app.static_folder, fn))
-    for token, lifetime in TOKENS_LIFETIME.items():
-        if time.time() - lifetime > 300:
-            remove_token_resources(token)
-    while len(TOKENS_LIFETIME) > 15:
-        token = max(TOKENS_LIFETIME, key=TOKENS_LIFETIME.get)
-        remove_token_resources(token)
+
+
+def restart_prefetch(token, session, start):
+    """Restarts prefetching of token images from index `start`"""
+    PREFETCHER.remove(token)
+    PREFETCHER.add(token, GENERATORS[token].generate_image_by_image(seed=session['seed'], start=start),
+                   after=ANALYSES[token])
+    PREFETCH_INDICES[token] = start
+
+
+def analyze_session(token, generator, stored):
+    generator.analyze()
+    if not stored:
+        SESSIONS.set_analysis(token, generator.to_snapshot())
+    return generator
+
+
+def get_local_generator(token, session):
+    """Returns GenImage of session, it is rebuilt from the session store if the token was created by another worker"""
+    with LOCAL_SESSIONS_LOCK:
+        if token in GENERATORS:
+            return GENERATORS[token]
+
+        kwargs = dict(image_bytes=SESSIONS.get_image(token), model=ESTIMATOR, forms_root=FORMS_ROOT,
+                      fonts_root=FONTS_ROOT, seg_model=SEG_MODELS.get_by_id(session['seg_model']),
+                      text=session['text'], mask_cache=MASK_CACHE)
+        analysis = SESSIONS.get_analysis(token)
+        generator = None
+        if analysis is not None:
+            try:
+                generator = main.GenImage.from_snapshot(analysis, **kwargs)
+            except ValueError as e:
+                print(f'Analysis snapshot of {token} is not restored: {e}')
+        stored = generator is not None
+        if generator is None:
+            generator = main.GenImage(**kwargs)
+
+        GENERATORS[token] = generator
+        PREFETCH_LOCKS[token] = threading.Lock()
+        ANALYSES[token] = ANALYSIS_POOL.submit(analyze_session, token, generator, stored)
+        restart_prefetch(token, session, session['next_index'])
+        return generator
+
+
+def _build_cors_preflight_response():
+    return Response(status=204, headers={'Access-Control-Allow-Origin': '*',
+                                         'Content-Type': 'application/json',
+                                         'Access-Control-Allow-Methods': ['POST', 'GET', 'OPTIONS'],
+                                         'Access-Control-Allow-Headers': ['X-PINGOTHER', 'Content-Type'],
+                                         'Access-Control-Max-Age': 86400})
+
+
+def _corsify_actual_response(response):
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+def get_analysis_state(token, session):
+    get_local_generator(token, session)
+    analysis = ANALYSES[token]
+    if not analysis.done():
+        return 'pending'
+    return 'failed' if analysis.cancelled() or analysis.exception() is not None else 'ready'
+
+
+@app.route('/api/status', methods=['GET', 'OPTIONS'])
+def analysis_status():
+    if request.method == 'OPTIONS':
+        return _build_cors_preflight_response()
+
+    token = request.args.get('token', default='*', type=str)
+    session = None if token == '*' else SESSIONS.get(token)
+    if session is None:
+        return _corsify_actual_response(Response('invalid token', status=400))
+
+    state = get_analysis_state(token, session)
+    return _corsify_actual_response(Response(json.dumps({'token': token, 'state': state}),
+                                             headers={'Content-Type': 'application/json'}, status=200))
 
 
 @app.route('/api/remove-token', methods=['GET', 'OPTIONS'])
@@ -69,7 +214,7 @@ def remove_token():
     if request.method == 'GET':
         token = request.args.get('token', default='*', type=str)
 
-        if token not in GENERATORS or token == '*':
+        if token == '*' or SESSIONS.get(token) is None:
             return Response('invalid token', status=400)
 
         remove_token_resources(token)
@@ -87,7 +232,7 @@ def remove_token():
 def prolong():
     if request.method == 'GET':
         token = request.args.get('token', default='*', type=str)
-        TOKENS_LIFETIME[token] = time.time()
+        SESSIONS.touch(token)
 
         return Response(status=200)
     elif request.method == 'OPTIONS':
@@ -113,16 +258,30 @@ def init_generator():
         if img_data == '*' or text == '*':
             return Response('no image or text data', status=400)
 
-        generator = main.GenImage(image_bytes=io.BytesIO(img_data).getvalue(), model=ESTIMATOR, forms_root=FORMS_ROOT,
-                                  fonts_root=FONTS_ROOT, seg_model=SEG_MODEL, text=text)
+        try:
+            # the tier may fall back under load, so the chosen model is stored and reused by every worker
+            seg_model = SEG_MODELS.get(request.json.get('quality'))
+        except ValueError as e:
+            return Response(str(e), status=400)
+
+        try:
+            image_decode.check_image(img_data)
+        except (IOError, ValueError):
+            return Response('invalid image', status=400)
+
+        seed = request.json.get('seed', random.randrange(2 ** 32))
+        if not isinstance(seed, int) or not 0 <= seed < 2 ** 32:
+            return Response('seed must be an integer in [0, 2**32)', status=400)
+
+        if sum(not analysis.done() for analysis in ANALYSES.values()) >= ANALYSIS_MAX_PENDING:
+            return Response('too many images are being analyzed', status=503, headers={'Retry-After': '5'})
 
         token = generate_token(10)
 
-        GENERATORS[token] = generator.generate_image_by_image()
-        TOKENS_LIFETIME[token] = time.time()
-        TOKENS_INDICES[token] = 0
+        SESSIONS.create(token, io.BytesIO(img_data).getvalue(), text, seg_model.model_id, seed)
 
-        return Response(json.dumps({'token': token}), status=201)
+        return Response(json.dumps({'token': token, 'seed': seed,
+                                    'state': get_analysis_state(token, SESSIONS.get(token))}), status=201)
 
     elif request.method == 'OPTIONS':
         return Response(status=204, headers={'Access-Control-Allow-Origin': '*',
@@ -138,22 +297,74 @@ def init_generator():
 def get_next_image():
     if request.method == 'GET' or request.method == 'POST':
         token = request.args.get('token', default='*', type=str)
-        if token not in GENERATORS or token == '*':
+        session = None if token == '*' else SESSIONS.get(token)
+        if session is None:
+            remove_local_resources(token)
             return Response('invalid token', status=400)
 
-        generated_image = next(GENERATORS[token])
-        path = os.path.join('static', f'{token}_{TOKENS_INDICES[token]}.png')
-        generated_image.save(path)
-
-        TOKENS_INDICES[token] += 1
+        get_local_generator(token, session)
+        try:
+            ANALYSES[token].result(timeout=ANALYSIS_WAIT_TIMEOUT)
+        except TimeoutError:
+            return _corsify_actual_response(Response(json.dumps({'state': 'pending'}), status=202))
+        except Exception as e:
+            return _corsify_actual_response(Response(json.dumps({'state': 'failed', 'error': str(e)}), status=500))
+
+        with PREFETCH_LOCKS[token]:
+            # index is committed only after its image is saved, so failed renders don't skip images
+            while True:
+                session = SESSIONS.get(token)
+                if session is None:
+                    return Response('invalid token', status=400)
+                index = session['next_index']
+                if PREFETCH_INDICES[token] != index:
+                    # other workers served images of this token, prefetched images are not the next ones
+                    restart_prefetch(token, session, index)
+                PREFETCH_INDICES[token] = None  # a failed generator is restarted by the next request
+                generated_image = PREFETCHER.get(token)
+                PREFETCH_INDICES[token] = index + 1
+
+                path = os.path.join('static', f'{token}_{index}.png')
+                with open(path, 'wb') as f:
+                    f.write(patterns.encode_png(generated_image))
+
+                if SESSIONS.advance_index(token, index):
+                    break
+                # another worker has served index meanwhile, the next one is rendered instead
 
         return Response(json.dumps({'url': path}), 200)
     elif request.method == 'OPTIONS':
-        return Response(status=204, headers={'Access-Control-Allow-Origin': '*',
-                                             'Content-Type': 'application/json',
-                                             'Access-Control-Allow-Methods': ['POST', 'GET', 'OPTIONS'],
-                                             'Access-Control-Allow-Headers': ['X-PINGOTHER', 'Content-Type'],
-                                             'Access-Control-Max-Age': 86400})
+        return _build_cors_preflight_response()
+
+
+@app.route('/api/getimage', methods=['GET', 'OPTIONS'])
+def get_image():
+    """Renders image number `index` of the token sequence on demand, it is the same image getnextimage returns"""
+    if request.method == 'OPTIONS':
+        return _build_cors_preflight_response()
+
+    token = request.args.get('token', default='*', type=str)
+    index = request.args.get('index', default=-1, type=int)
+    session = None if token == '*' else SESSIONS.get(token)
+    if session is None:
+        return _corsify_actual_response(Response('invalid token', status=400))
+    if index < 0:
+        return _corsify_actual_response(Response('invalid index', status=400))
+
+    get_local_generator(token, session)
+    try:
+        generator = ANALYSES[token].result(timeout=ANALYSIS_WAIT_TIMEOUT)
+    except TimeoutError:
+        return _corsify_actual_response(Response(json.dumps({'state': 'pending'}), status=202))
+    except Exception as e:
+        return _corsify_actual_response(Response(json.dumps({'state': 'failed', 'error': str(e)}), status=500))
+
+    path = os.path.join('static', f'{token}_{index}.png')
+    if not os.path.exists(path):
+        with open(path, 'wb') as f:
+            f.write(patterns.encode_png(generator.render_image(index, session['seed'])))
+
+    return _corsify_actual_response(Response(json.dumps({'url': path}), 200))
 
 
 # DEPRECIATED
@@ -161,10 +372,11 @@ def get_next_image():
 def display_single_image():
     token = request.args.get('token', default='*', type=str)
     index = request.args.get('index', default=-1, type=int)
+    session = None if token == '*' else SESSIONS.get(token)
 
-    if token not in GENERATORS or token == '*':
+    if session is None:
         return Response('invalid token', status=400)
-    if TOKENS_INDICES[token] < index or index < 0:
+    if session['next_index'] < index or index < 0:
         return Response('invalid index', status=400)
 
     if os.path.exists(os.path.join(app.static_folder, f'{token}_{index}.png')):
@@ -186,17 +398,18 @@ def generate():
                 return Response(status=400)
             img_data = b64decode(request.json.get('image', ''))
 
+            try:
+                seg_model = SEG_MODELS.get(request.json.get('quality'))
+            except ValueError as e:
+                return Response(str(e), status=400)
+
             images = generate_images(io.BytesIO(img_data).getvalue(), ESTIMATOR, FORMS_ROOT, FONTS_ROOT,
-                                     SEG_MODEL, text)
+                                     seg_model, text)
 
             encoded_images = list()
 
             for image in images:
-                img_arr = io.BytesIO()
-                image.save(img_arr, 'PNG')
-                img_arr.seek(0)
-
-                encoded_images.append(b64encode(img_arr.getvalue()).decode('utf-8'))
+                encoded_images.append(b64encode(patterns.encode_png(image)).decode('utf-8'))
 
             return Response(json.dumps({'images': encoded_images}), headers={'Access-Control-Allow-Origin': '*',
                                                                              'Content-Type': 'application/json'}), 201
@@ -206,24 +419,21 @@ def generate():
             text = request.form['text']
             if file.filename == '':
                 return Response(status=400)
-            img = Image.open(file)
-
-            img_bytes = io.BytesIO()
-            img.save(img_bytes, format='PNG')
+            try:
+                seg_model = SEG_MODELS.get(request.form.get('quality'))
+            except ValueError as e:
+                return Response(str(e), status=400)
+            img_bytes = file.read()
 
             start = time.time()
 
-            images = generate_images(img_bytes.getvalue(), ESTIMATOR, FORMS_ROOT, FONTS_ROOT, SEG_MODEL, text)
+            images = generate_images(img_bytes, ESTIMATOR, FORMS_ROOT, FONTS_ROOT, seg_model, text)
 
             end = round(time.time() - start, 2)
 
             encoded_images = list()
             for image in images:
-                img_arr = io.BytesIO()
-                image.save(img_arr, 'PNG')
-                img_arr.seek(0)
-
-                encoded_images.append(b64encode(img_arr.getvalue()).decode('utf-8'))
+                encoded_images.append(b64encode(patterns.encode_png(image)).decode('utf-8'))
 
             print(f'Mem usage before return: {process.memory_info().rss / 1024 // 1024} MB')
 
@@ -238,6 +448,17 @@ def generate():
         return render_template('gen_input_page.html')
 
 
+@app.route('/api/stats', methods=['GET'])
+def stats():
+    return Response(json.dumps({'scorer': {'backend': SCORER_BACKEND, 'agreement': SCORER_AGREEMENT},
+                                'layout_memo': evaluatablegeneration_v2.LAYOUT_MEMO.get_stats(),
+                                'layout_prefilter': evaluatablegeneration_v2.LAYOUT_PREFILTER.get_stats(),
+                                'static_patterns': {'hits': patterns.STATIC_PATTERN_CACHE.hits,
+                                                    'misses': patterns.STATIC_PATTERN_CACHE.misses},
+                                'prefetch': PREFETCHER.get_stats()}),
+                    headers={'Access-Control-Allow-Origin': '*', 'Content-Type': 'application/json'}, status=200)
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -0,0 +1,76 @@
+from functools import lru_cache
+from PIL import Image
+import os
+import os.path as osp
+import threading
+
+CHECKMARK_COLORS = ('cr', 'lg', 'mg', 'mo', 'yel')
+BIG_CHECKMARKS_COLORS = ('g', 'do', 'lo')
+
+# (asset, size, thumbnail) used by patterns, they are decoded and scaled by AssetRegistry.preload
+PATTERN_ASSETS = [('1/vacancy_bg.png', None, False), ('1/vacancy.png', None, False)] + \
+                 [(f'1/checkmarks_big_{color}.png', None, False) for color in BIG_CHECKMARKS_COLORS] + \
+                 [(f'1/mask_{color}.png', None, False) for color in CHECKMARK_COLORS] + \
+                 [(f'cm_{side}_{color}.png', size, True) for color in CHECKMARK_COLORS for side in ('l', 'r')
+                  for size in ((27, 43), (29, 46), (40, 65), (54, 86), (69, 110))]
+
+
+class AssetRegistry(object):
+    """Decoded and prescaled pattern assets shared by all patterns
+
+    Returned images are shared between threads and must not be modified, patterns only paste them.
+
+    Args:
+      forms_root: str, directory with forms images
+    """
+
+    def __init__(self, forms_root):
+        self.forms_root = forms_root
+        self.triangles = sorted(fn for fn in os.listdir(forms_root)
+                                if 'triangle_br' in fn and 's' not in fn and 'big' not in fn
+                                and osp.isfile(osp.join(forms_root, fn)))
+        self._images = dict()
+        self._lock = threading.Lock()
+
+    def get(self, name, size=None, thumbnail=False):
+        """
+        Args:
+          name: str, asset path relative to forms_root
+          size: tuple, (width, height) to scale asset to, original size if None
+          thumbnail: bool, scale keeping aspect ratio within size like PIL.Image.thumbnail
+        Returns:
+          PIL.Image
+        """
+        key = (name, size, thumbnail)
+        image = self._images.get(key)
+        if image is not None:
+            return image
+
+        if size is None:
+            image = Image.open(osp.join(self.forms_root, name))
+            image.load()
+        elif thumbnail:
+            image = self.get(name).copy()
+            image.thumbnail(size)
+        else:
+            image = self.get(name).resize(size)
+
+        with self._lock:
+            return self._images.setdefault(key, image)
+
+    def get_triangle(self, index, size=(112, 112)):
+        return self.get(self.triangles[index], size)
+
+    def preload(self):
+        """Decodes and scales all assets used by patterns"""
+        for name, size, thumbnail in PATTERN_ASSETS:
+            self.get(name, size, thumbnail)
+        for index in range(len(self.triangles)):
+            self.get_triangle(index)
+        return self
+
+
+@lru_cache(maxsize=None)
+def get_assets(forms_root):
+    """Returns process-wide AssetRegistry for forms_root"""
+    return AssetRegistry(forms_root)
@@ -0,0 +1,160 @@
+from collections import OrderedDict
+import hashlib
+import numpy as np
+import os
+import tempfile
+import threading
+import zipfile
+
+
+class LRUCache(object):
+    """Thread-safe LRU cache bounded by total size of stored values
+
+    Args:
+      max_size: int, maximum total size of values
+      size_fn: callable, returns size of a value, by default every value has size 1
+    """
+
+    def __init__(self, max_size, size_fn=None):
+        self.max_size = max_size
+        self.size_fn = size_fn or (lambda value: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def put(self, key, value):
+        size = self.size_fn(value)
+        if size > self.max_size:
+            return
+
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.size -= evicted_size
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            value, size = self._items.pop(key)
+            self.size -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+class MaskCache(object):
+    """Content-addressed cache of segmentation masks
+
+    Masks are keyed by a hash of the image bytes and the segmentation model id. Recently used masks are kept
+    in memory, optionally masks are also stored as compressed npz files in `cache_dir`.
+
+    Args:
+      max_bytes: int, memory limit for cached masks
+      cache_dir: str, directory for the on-disk tier, disabled if None
+      max_disk_bytes: int, limit for files in cache_dir, the least recently used ones are removed over it
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, cache_dir=None, max_disk_bytes=1024 * 1024 * 1024):
+        self.memory = LRUCache(max_bytes, size_fn=lambda mask: mask.nbytes)
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(image_bytes, model_id):
+        return f'{model_id}_{hashlib.sha256(image_bytes).hexdigest()}'
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    @staticmethod
+    def _remove(path):
+        # other workers may have removed the file already
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def get(self, image_bytes, model_id):
+        """Returns a copy of cached mask or None"""
+        key = self.get_key(image_bytes, model_id)
+        mask = self.memory.get(key)
+
+        if mask is None and self.cache_dir is not None and os.path.exists(self._get_path(key)):
+            path = self._get_path(key)
+            try:
+                with np.load(path) as data:
+                    mask = data['mask']
+                os.utime(path)  # modification time orders files for eviction
+            except (IOError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+                # truncated or corrupt file, the mask is computed and stored again
+                self._remove(path)
+                return None
+            self.memory.put(key, mask)
+
+        return None if mask is None else mask.copy()
+
+    def put(self, image_bytes, model_id, mask):
+        key = self.get_key(image_bytes, model_id)
+        mask = np.asarray(mask).astype(np.uint8)
+        self.memory.put(key, mask)
+
+        if self.cache_dir is not None:
+            # unique temporary file, so threads and worker processes never write the same one
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez_compressed(f, mask=mask)
+                os.replace(tmp_path, self._get_path(key))
+            except Exception:
+                self._remove(tmp_path)
+                raise
+            self._evict_files()
+
+    def _evict_files(self):
+        """Removes the least recently used files while cache_dir takes more than max_disk_bytes"""
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, path in sorted(files):
+            if size <= self.max_disk_bytes:
+                break
+            self._remove(path)
+            size -= file_size
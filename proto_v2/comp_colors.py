@@ -1,10 +1,21 @@
 import math
 import numpy as np
+from functools import lru_cache
 from PIL import Image
-from colorthief import ColorThief
-from colormath.color_diff import delta_e_cie2000
-from colormath.color_conversions import convert_color
-from colormath.color_objects import sRGBColor, LabColor
+
+BASE_COLORS = ((0, 170, 19), (255, 117, 0), (151, 215, 0), (255, 198, 0), (224, 0, 77))
+
+# sRGB (D65) to XYZ matrix and D65 reference white, same as in colormath
+RGB_TO_XYZ = np.array(((0.412424, 0.357579, 0.180464),
+                       (0.212656, 0.715158, 0.0721856),
+                       (0.0193324, 0.119193, 0.950444)))
+D65_WHITE = np.array((0.95047, 1.00000, 1.08883))
+CIE_E = 216.0 / 24389.0
+
+SIGBITS = 5
+RSHIFT = 8 - SIGBITS
+MAX_ITERATION = 1000
+FRACT_BY_POPULATIONS = 0.75
 
 
 def hilo(a, b, c):
@@ -22,8 +33,179 @@ def complement(r, g, b):
     return tuple(k - u for u in (r, g, b))
 
 
-def get_complement_colors(image, colors_n):
-    palette = ColorThief(image).get_palette(color_count=colors_n - 1)
+class VBox(object):
+    """3d box in quantized color space, (r1, r2, g1, g2, b1, b2) bounds are inclusive"""
+
+    def __init__(self, bounds, histo):
+        self.bounds = list(bounds)
+        self.histo = histo
+        self._count = None
+
+    def copy(self):
+        return VBox(self.bounds, self.histo)
+
+    def get_slice(self):
+        r1, r2, g1, g2, b1, b2 = self.bounds
+        return self.histo[r1:r2 + 1, g1:g2 + 1, b1:b2 + 1]
+
+    @property
+    def count(self):
+        if self._count is None:
+            self._count = int(self.get_slice().sum())
+        return self._count
+
+    @property
+    def volume(self):
+        r1, r2, g1, g2, b1, b2 = self.bounds
+        return (r2 - r1 + 1) * (g2 - g1 + 1) * (b2 - b1 + 1)
+
+    @property
+    def avg(self):
+        mult = 1 << RSHIFT
+        r1, r2, g1, g2, b1, b2 = self.bounds
+        box = self.get_slice()
+        ntot = box.sum()
+        if not ntot:
+            return (int(mult * (r1 + r2 + 1) / 2), int(mult * (g1 + g2 + 1) / 2), int(mult * (b1 + b2 + 1) / 2))
+
+        sums = [np.dot(box.sum(axis=axes), np.arange(low, high + 1) + 0.5) * mult
+                for axes, low, high in (((1, 2), r1, r2), ((0, 2), g1, g2), ((0, 1), b1, b2))]
+        return tuple(int(channel_sum / ntot) for channel_sum in sums)
+
+
+def median_cut_apply(vbox):
+    """Splits vbox in two along its longest side at the median of its population"""
+    if not vbox.count:
+        return None, None
+    if vbox.count == 1:
+        return vbox.copy(), None
+
+    widths = [vbox.bounds[2 * i + 1] - vbox.bounds[2 * i] + 1 for i in range(3)]
+    axis = widths.index(max(widths))
+    other_axes = tuple(i for i in range(3) if i != axis)
+
+    dim1, dim2 = vbox.bounds[2 * axis], vbox.bounds[2 * axis + 1]
+    partialsum = np.cumsum(vbox.get_slice().sum(axis=other_axes))
+    total = partialsum[-1]
+    lookaheadsum = total - partialsum
+
+    def get_partialsum(i):
+        return partialsum[i - dim1] if dim1 <= i <= dim2 else 0
+
+    above_half = np.nonzero(partialsum > total / 2)[0]
+    if not above_half.size:
+        return None, None
+
+    i = dim1 + int(above_half[0])
+    left, right = i - dim1, dim2 - i
+    if left <= right:
+        d2 = min(dim2 - 1, int(i + right / 2))
+    else:
+        d2 = max(dim1, int(i - 1 - left / 2))
+
+    # avoid 0-count boxes
+    while not get_partialsum(d2):
+        d2 += 1
+    count2 = lookaheadsum[d2 - dim1]
+    while not count2 and get_partialsum(d2 - 1):
+        d2 -= 1
+        count2 = lookaheadsum[d2 - dim1]
+
+    vbox1, vbox2 = vbox.copy(), vbox.copy()
+    vbox1.bounds[2 * axis + 1] = d2
+    vbox2.bounds[2 * axis] = d2 + 1
+    return vbox1, vbox2
+
+
+def quantize(pixels, max_color):
+    """Modified median cut quantization (MMCQ), NumPy port of ColorThief's implementation
+
+    Parameters:
+      pixels: np.array of shape (n, 3) with uint8 RGB values
+      max_color: max number of colors
+    Return:
+      list of (r, g, b) colors sorted by population times volume
+    """
+    if not len(pixels):
+        raise ValueError('Empty pixels when quantize.')
+    if max_color < 2 or max_color > 256:
+        raise ValueError('Wrong number of max colors when quantize.')
+
+    quantized = pixels.astype(np.int64) >> RSHIFT
+    indices = (quantized[:, 0] << (2 * SIGBITS)) + (quantized[:, 1] << SIGBITS) + quantized[:, 2]
+    histo = np.bincount(indices, minlength=1 << (3 * SIGBITS)).reshape((1 << SIGBITS,) * 3)
+
+    mins, maxs = quantized.min(axis=0), quantized.max(axis=0)
+    boxes = [VBox((mins[0], maxs[0], mins[1], maxs[1], mins[2], maxs[2]), histo)]
+
+    def pop(sort_key):
+        boxes.sort(key=sort_key)
+        return boxes.pop()
+
+    def iterate(sort_key, target):
+        n_color = 1
+        n_iter = 0
+        while n_iter < MAX_ITERATION:
+            vbox = pop(sort_key)
+            if not vbox.count:
+                boxes.append(vbox)
+                n_iter += 1
+                continue
+
+            vbox1, vbox2 = median_cut_apply(vbox)
+            if not vbox1:
+                raise RuntimeError("vbox1 not defined; shouldn't happen!")
+            boxes.append(vbox1)
+            if vbox2:
+                boxes.append(vbox2)
+                n_color += 1
+            if n_color >= target:
+                return
+            n_iter += 1
+
+    def by_count(box):
+        return box.count
+
+    def by_count_and_volume(box):
+        return box.count * box.volume
+
+    iterate(by_count, FRACT_BY_POPULATIONS * max_color)
+    # boxes are moved to the second queue in order of decreasing population
+    boxes.sort(key=by_count)
+    boxes.reverse()
+    iterate(by_count_and_volume, max_color - len(boxes))
+
+    boxes.sort(key=by_count_and_volume)
+    return [box.avg for box in reversed(boxes)]
+
+
+def get_palette(image, color_count=10, quality=1):
+    """
+    Parameters:
+      image: PIL.Image
+      color_count: the size of the palette
+      quality: pixels sampling step
+    Return:
+      list of (r, g, b) palette colors, same as ColorThief.get_palette
+    """
+    pixels = np.asarray(image.convert('RGBA')).reshape(-1, 4)[::quality]
+    # mostly opaque and not white pixels
+    valid = (pixels[:, 3] >= 125) & ~(pixels[:, :3] > 250).all(axis=1)
+    return quantize(pixels[valid, :3], color_count)
+
+
+def get_complement_colors(image, colors_n, quality=1):
+    """
+    Parameters:
+      image: PIL.Image (preferably downsampled), image bytes or file object
+      colors_n
+      quality: pixels sampling step
+    Return:
+      complements of the palette colors
+    """
+    if not isinstance(image, Image.Image):
+        image = Image.open(image)
+    palette = get_palette(image, color_count=colors_n - 1, quality=quality)
     return [complement(*rgb) for rgb in palette]
 
 
@@ -35,9 +217,97 @@ def display_colors(colors, size=128):
     return Image.fromarray(data)
 
 
+def rgb_to_lab(colors):
+    """Converts colors to CIE Lab (D65)
+
+    Values are used as is, the same way colormath treats sRGBColor(r, g, b) built from 0-255 values.
+
+    Parameters:
+      colors: array-like of shape (n, 3)
+    Return:
+      np.array of shape (n, 3)
+    """
+    rgb = np.asarray(colors, dtype=np.float64).reshape(-1, 3)
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, np.power((rgb + 0.055) / 1.055, 2.4))
+    xyz = linear.dot(RGB_TO_XYZ.T) / D65_WHITE
+    xyz = np.where(xyz > CIE_E, np.cbrt(xyz), 7.787 * xyz + 16.0 / 116.0)
+    return np.stack((116.0 * xyz[:, 1] - 16.0,
+                     500.0 * (xyz[:, 0] - xyz[:, 1]),
+                     200.0 * (xyz[:, 1] - xyz[:, 2])), axis=1)
+
+
+@lru_cache(maxsize=32)
+def get_palette_lab(palette):
+    """Cached rgb_to_lab for constant palettes, palette is a tuple of (r, g, b) tuples"""
+    lab = rgb_to_lab(palette)
+    lab.setflags(write=False)
+    return lab
+
+
+def delta_e_cie2000(lab1, lab2):
+    """Pairwise CIEDE2000 distances (Kl = Kc = Kh = 1), follows colormath's implementation
+
+    Parameters:
+      lab1: np.array of shape (n, 3)
+      lab2: np.array of shape (m, 3)
+    Return:
+      np.array of shape (n, m)
+    """
+    L1, a1, b1 = (lab1[:, i, np.newaxis] for i in range(3))
+    L2, a2, b2 = (lab2[np.newaxis, :, i] for i in range(3))
+
+    avg_Lp = (L1 + L2) / 2.0
+
+    C1 = np.sqrt(a1 ** 2 + b1 ** 2)
+    C2 = np.sqrt(a2 ** 2 + b2 ** 2)
+    avg_C1_C2 = (C1 + C2) / 2.0
+
+    G = 0.5 * (1 - np.sqrt(avg_C1_C2 ** 7.0 / (avg_C1_C2 ** 7.0 + 25.0 ** 7.0)))
+
+    a1p = (1.0 + G) * a1
+    a2p = (1.0 + G) * a2
+
+    C1p = np.sqrt(a1p ** 2 + b1 ** 2)
+    C2p = np.sqrt(a2p ** 2 + b2 ** 2)
+    avg_C1p_C2p = (C1p + C2p) / 2.0
+
+    h1p = np.degrees(np.arctan2(b1, a1p))
+    h1p = h1p + (h1p < 0) * 360
+    h2p = np.degrees(np.arctan2(b2, a2p))
+    h2p = h2p + (h2p < 0) * 360
+
+    avg_Hp = (((np.fabs(h1p - h2p) > 180) * 360) + h1p + h2p) / 2.0
+
+    T = 1 - 0.17 * np.cos(np.radians(avg_Hp - 30)) + \
+        0.24 * np.cos(np.radians(2 * avg_Hp)) + \
+        0.32 * np.cos(np.radians(3 * avg_Hp + 6)) - \
+        0.2 * np.cos(np.radians(4 * avg_Hp - 63))
+
+    diff_h2p_h1p = h2p - h1p
+    delta_hp = diff_h2p_h1p + (np.fabs(diff_h2p_h1p) > 180) * 360
+    delta_hp = delta_hp - (h2p > h1p) * 720
+
+    delta_Lp = L2 - L1
+    delta_Cp = C2p - C1p
+    delta_Hp = 2 * np.sqrt(C2p * C1p) * np.sin(np.radians(delta_hp) / 2.0)
+
+    S_L = 1 + ((0.015 * (avg_Lp - 50) ** 2) / np.sqrt(20 + (avg_Lp - 50) ** 2.0))
+    S_C = 1 + 0.045 * avg_C1p_C2p
+    S_H = 1 + 0.015 * avg_C1p_C2p * T
+
+    delta_ro = 30 * np.exp(-(((avg_Hp - 275) / 25) ** 2.0))
+    R_C = np.sqrt(avg_C1p_C2p ** 7.0 / (avg_C1p_C2p ** 7.0 + 25.0 ** 7.0))
+    R_T = -2 * R_C * np.sin(2 * np.radians(delta_ro))
+
+    return np.sqrt(
+        (delta_Lp / S_L) ** 2 +
+        (delta_Cp / S_C) ** 2 +
+        (delta_Hp / S_H) ** 2 +
+        R_T * (delta_Cp / S_C) * (delta_Hp / S_H))
+
+
 def get_colors_dist(color1, color2):
-    return delta_e_cie2000(convert_color(sRGBColor(*color1), LabColor),
-                           convert_color(sRGBColor(*color2), LabColor))
+    return float(delta_e_cie2000(rgb_to_lab([color1]), rgb_to_lab([color2]))[0, 0])
 
 
 def get_true(color, result):
@@ -48,16 +318,25 @@ def get_true(color, result):
 
 
 def get_based_colors(base, comp):
-    result = []
-    for comp_color in comp:
-        dists = {}
-        for base_color in base:
-            dists[base_color] = get_colors_dist(comp_color, base_color)
-        for color in sorted(dists, key=dists.get):
-            if color in result:
+    """
+    Parameters:
+      base: list of (r, g, b) base colors
+      comp: list of (r, g, b) colors to match
+    Return:
+      list of distinct base colors closest to comp colors
+    """
+    base = tuple(tuple(color) for color in base)
+    base_lab = get_palette_lab(base)
+    base_dists = delta_e_cie2000(base_lab, base_lab)
+    dists = delta_e_cie2000(rgb_to_lab(comp), base_lab) if len(comp) else np.zeros((0, len(base)))
+
+    result_indices = []
+    for comp_dists in dists:
+        for i in np.argsort(comp_dists, kind='stable'):
+            if i in result_indices:
                 continue
-            if not get_true(color, result):
+            if (base_dists[i, result_indices] < 20).any():
                 continue
-            result.append(color)
+            result_indices.append(i)
             break
-    return result
+    return [base[i] for i in result_indices]
@@ -1,6 +1,9 @@
+from functools import lru_cache
 from PIL import Image
+import os
 import os.path as osp
 import numpy as np
+from .caching import LRUCache
 
 
 class ImageGrid(object):
@@ -11,13 +14,27 @@ class ImageGrid(object):
     __height = 200
     __width = 200
     __map = np.zeros((200, 200))
+    __occupancy = np.zeros((200, 200), dtype=bool)
+    __masks = dict()
+    __resized = None
     __forms = list()
     __coordinates = list()
 
-    def __init__(self, height, width):
+    def __init__(self, height, width, mask_cache=None, resize_cache=None):
+        """
+        Args:
+          height: int, canvas height
+          width: int, canvas width
+          mask_cache: dict-like, cache of resized images alpha masks which may be shared between grids,
+                      it is keyed by image id, so images must outlive it
+          resize_cache: dict-like, cache of resized images for rendering, keyed the same way
+        """
         self.__height = height
         self.__width = width
         self.__map = np.zeros((height, width))
+        self.__occupancy = np.zeros((height, width), dtype=bool)
+        self.__masks = dict() if mask_cache is None else mask_cache
+        self.__resized = resize_cache
         self.__forms = list()
         self.__coordinates = list()  # (x1, y1, x2, y2)    !!!(y1, x1, y2, x2)!!!
 
@@ -29,13 +46,43 @@ class ImageGrid(object):
         """
         return self.__height, self.__width
 
+    def get_mask(self, image, size):
+        """Returns non-transparent pixels mask of resized image
+
+           Args:
+            image: PIL.Image, image to get mask of
+            size: tuple, (width, height), size to resize image to
+
+           Returns:
+            np.array of bool with shape (height, width)
+        """
+        key = (id(image), size)
+        mask = self.__masks.get(key)
+        if mask is None:
+            mask = np.atleast_3d(np.array(image.resize(size))).any(axis=2)
+            mask.setflags(write=False)
+            self.__masks[key] = mask
+        return mask
+
+    def get_resized(self, image, size):
+        """Returns image resized for rendering, uses resize_cache if it was given"""
+        if self.__resized is None:
+            return image.resize(size, Image.ANTIALIAS)
+
+        key = (id(image), size)
+        resized = self.__resized.get(key)
+        if resized is None:
+            resized = image.resize(size, Image.ANTIALIAS)
+            self.__resized[key] = resized
+        return resized
+
     def get_intersection(self, image, coordinates):
         """Calculates intersection between new image which is being placed on canvas and canvas elements.
            Since images may have transparent pixels this func considers:
            1. Stacking images on transparent canvas parts
            2. Stacking images on non-transparent canvas parts in way that won't affect origin canvas
 
-           Intersection is calculated with non-zero pixels sum comparison
+           Intersection is calculated against occupancy bitmap of non-transparent canvas pixels
 
            Args:
             image: PIL.Image, image to check intersection with
@@ -46,17 +93,14 @@ class ImageGrid(object):
 
         """
 
-        map_slice = self.render_slice(coordinates)
-        size = (coordinates[3] - coordinates[1], coordinates[2] - coordinates[0])
-        image_matrix = np.array(image.resize(size)).sum(axis=2)
-        if map_slice.any():
-            map_slice_nonzero = np.count_nonzero(map_slice)
-            image_matrix_nonzero = np.count_nonzero(image_matrix)
-            sum_nonzero = np.count_nonzero(np.add(map_slice, image_matrix))
-            return map_slice_nonzero + image_matrix_nonzero != sum_nonzero
-        else:
+        occupancy_slice = self.__occupancy[coordinates[0]: coordinates[2], coordinates[1]: coordinates[3]]
+        if not occupancy_slice.any():
             return False
 
+        size = (coordinates[3] - coordinates[1], coordinates[2] - coordinates[0])
+        image_mask = self.get_mask(image, size)[:occupancy_slice.shape[0], :occupancy_slice.shape[1]]
+        return bool(np.logical_and(occupancy_slice, image_mask).any())
+
     def add_image(self, image, coordinates):
         """Adds an image to canvas if it has no intersection
 
@@ -69,9 +113,13 @@ class ImageGrid(object):
 
         """
         if not self.get_intersection(image, coordinates):
-            self.__forms.append(image.convert('RGBA'))
+            self.__forms.append(image if image.mode == 'RGBA' else image.convert('RGBA'))
             self.__coordinates.append(coordinates)
             self.__map[coordinates[0]: coordinates[2], coordinates[1]: coordinates[3]] = len(self.__forms)
+
+            occupancy_slice = self.__occupancy[coordinates[0]: coordinates[2], coordinates[1]: coordinates[3]]
+            size = (coordinates[3] - coordinates[1], coordinates[2] - coordinates[0])
+            occupancy_slice |= self.get_mask(image, size)[:occupancy_slice.shape[0], :occupancy_slice.shape[1]]
         else:
             raise ValueError(
                 'there is an intersection between __map and new image, try to alter size and/or __coordinates')
@@ -115,29 +163,107 @@ class ImageGrid(object):
                         int(self.__coordinates[i][3] * height_coef))
             size = (scaled_c[2] - scaled_c[0], scaled_c[3] - scaled_c[1])
 
-            output_image[scaled_c[0]: scaled_c[2], scaled_c[1]: scaled_c[3]] += self.__forms[i].resize(
-                (size[1], size[0]), Image.ANTIALIAS)
+            output_image[scaled_c[0]: scaled_c[2], scaled_c[1]: scaled_c[3]] += self.get_resized(
+                self.__forms[i], (size[1], size[0]))
 
         return Image.fromarray(output_image.astype(np.uint8))
 
 
+class SpriteAtlas(object):
+    """Decoded RGBA forms shared by all ImageGenerator objects
+
+    Args:
+      forms_root: str, directory with forms images
+      max_resized: int, max count of cached resized forms and their masks
+    """
+
+    def __init__(self, forms_root, max_resized=4096):
+        self.forms_root = forms_root
+        self.figures = dict()
+        for fn in sorted(os.listdir(forms_root)):
+            path = osp.join(forms_root, fn)
+            if osp.isfile(path):
+                self.figures[path] = Image.open(path).convert('RGBA')
+
+        self.masks = LRUCache(max_resized)
+        self.resized = LRUCache(max_resized)
+
+    def get_paths(self, forms_type='all'):
+        """
+        Args:
+          forms_type: string, c for checkmarks, t for triangles, rest for all
+        Returns:
+          list of forms paths
+        """
+        if forms_type == 'c':
+            return [path for path in self.figures if 'cm' in osp.basename(path)]
+        elif forms_type == 't':
+            return [path for path in self.figures if 'triangle' in osp.basename(path)
+                    and 's' not in osp.basename(path) and 'big' not in osp.basename(path)]
+        else:
+            return [path for path in self.figures if 'big' not in osp.basename(path)]
+
+    def get_figure(self, path):
+        if path not in self.figures:
+            raise ValueError(f'{path} doesn\'t exist')
+        return self.figures[path]
+
+
+@lru_cache(maxsize=None)
+def get_atlas(forms_root):
+    """Returns process-wide SpriteAtlas for forms_root"""
+    return SpriteAtlas(forms_root)
+
+
 class ImageGenerator(object):
     __paths = list()
     __size = (0, 0)
     __figures = list()
     __fig_count = 0
     __fig_size_range = (0, 0)
+    __masks = dict()
+    __resized = None
+    __last_layout = tuple()
+    __rng = np.random
 
     def get_paths(self):
         return self.__paths
 
-    def __init__(self, paths, img_size, fig_count, fig_size_range):
+    def get_size(self):
+        return self.__size
+
+    def get_last_layout(self):
+        """Returns placements of the last generated image as tuple of (path, x, y, x_size, y_size)"""
+        return self.__last_layout
+
+    def __init__(self, paths, img_size, fig_count, fig_size_range, atlas=None, rng=None):
+        """
+        Args:
+          paths: list of forms paths
+          img_size: tuple, canvas size
+          fig_count: count of figures to place
+          fig_size_range: tuple, range of figure sizes
+          atlas: SpriteAtlas, forms are taken from it instead of being read from disk
+          rng: np.random.RandomState, source of randomness, global np.random if None
+        """
+        self.__rng = np.random if rng is None else rng
         self.__paths = list()
         self.__figures = list()
+        self.__last_layout = tuple()
         self.__size = img_size
         self.__fig_count = fig_count
         self.__fig_size_range = fig_size_range
 
+        if atlas is not None:
+            self.__masks = atlas.masks
+            self.__resized = atlas.resized
+            for path in paths:
+                self.__figures.append(atlas.get_figure(path))
+                self.__paths.append(path)
+            return
+
+        self.__masks = dict()
+        self.__resized = None
         for path in paths:
             if osp.exists(path):
                 self.__paths.append(path)
@@ -151,11 +277,21 @@ class ImageGenerator(object):
     def __next__(self):
         return self._get_random_image()
 
-    def _get_random_image(self):  # Если картинки могут заходить друг на друга, то distance_range=-1
-        image_grid = ImageGrid(self.__size[0], self.__size[1])
+    def _get_random_image(self):
+        return self.get_random_grid().render_image()
+
+    def get_random_grid(self):  # Если картинки могут заходить друг на друга, то distance_range=-1
+        """Places figures randomly without rendering them, placements are returned by get_last_layout
+
+           Returns:
+            ImageGrid, call render_image to get PIL.Image
+        """
+        image_grid = ImageGrid(self.__size[0], self.__size[1], mask_cache=self.__masks,
+                               resize_cache=self.__resized)
 
         checked_points = []
         centers = []
+        placements = []
         i = 0
 
         x, y = 0, 0
@@ -164,19 +300,19 @@ class ImageGenerator(object):
             i += 1
             iterations = 0
 
-            random_idx = np.random.randint(len(self.__figures))
+            random_idx = self.__rng.randint(len(self.__figures))
             fig = self.__figures[random_idx]
             aspect_ratio = fig.size[0] / fig.size[1]
 
-            x_size = np.random.randint(self.__fig_size_range[0], self.__fig_size_range[1])
+            x_size = self.__rng.randint(self.__fig_size_range[0], self.__fig_size_range[1])
             y_size = int(x_size * aspect_ratio)
 
             x_max = self.__size[0] - int(self.__fig_size_range[0] * aspect_ratio)
             y_max = self.__size[1] - self.__fig_size_range[0]
 
             while iterations < 200:
-                x = np.random.randint(0, x_max)
-                y = np.random.randint(0, y_max)
+                x = self.__rng.randint(0, x_max)
+                y = self.__rng.randint(0, y_max)
 
                 if x + x_size < self.__size[0] and y + y_size < self.__size[1]:
                     if (
@@ -189,15 +325,44 @@ class ImageGenerator(object):
                 iterations += 1
 
             if iterations >= 200:
-                image_grid = ImageGrid(self.__size[0], self.__size[1])
+                image_grid = ImageGrid(self.__size[0], self.__size[1], mask_cache=self.__masks,
+                                       resize_cache=self.__resized)
 
                 checked_points = []
                 centers = []
+                placements = []
                 i = 0
 
                 continue
 
             centers.append((x + x_size / 2, y + y_size / 2))
+            placements.append((self.__paths[random_idx], x, y, x_size, y_size))
             image_grid.add_image(fig, (x, y, x + x_size, y + y_size))
 
+        self.__last_layout = tuple(placements)
+
+        return image_grid
+
+    def render_layout(self, layout):
+        """Renders given placements
+
+           Args:
+            layout: tuple of (path, x, y, x_size, y_size), paths must be known to this generator
+
+           Returns:
+            PIL.Image or None if figures intersect or don't fit on canvas
+        """
+        image_grid = ImageGrid(self.__size[0], self.__size[1], mask_cache=self.__masks,
+                               resize_cache=self.__resized)
+
+        for path, x, y, x_size, y_size in layout:
+            if x < 0 or y < 0 or x + x_size >= self.__size[0] or y + y_size >= self.__size[1]:
+                return None
+            try:
+                image_grid.add_image(self.__figures[self.__paths.index(path)], (x, y, x + x_size, y + y_size))
+            except ValueError:
+                return None
+
+        self.__last_layout = tuple(layout)
+
         return image_grid.render_image()
@@ -1,7 +1,10 @@
+from collections import deque
 from PIL import ImageOps
-import os
+import threading
 from tensorflow.keras.applications.efficientnet import preprocess_input
 from .complexforms_v2 import *
+from .caching import LRUCache
+from .scorers import KerasScorer
 
 
 def resize_image_with_pad(image, size=(150, 150)):
@@ -48,37 +51,266 @@ def alpha_to_color(image, color=(255, 255, 255)):
     return background
 
 
-def generate_good_image(generator, model, threshold=0.5):
+def preprocess_images(images, size):
+    """Converts generated RGBA images to scorer model input
+    Args:
+      images: list of PIL.Image
+      size: tuple, model input size
+    Returns:
+      np.ndarray batch
+    """
+    x = np.array([np.array(resize_image_with_pad(alpha_to_color(img), size)) for img in images])
+    return preprocess_input(x)
+
+
+def get_scorer(model):
+    """Wraps Keras models into KerasScorer, scorers are returned as is"""
+    return model if hasattr(model, 'score') else KerasScorer(model)
+
+
+def score_images(images, model):
+    """Scores images with a single model call
+    Args:
+      images: list of PIL.Image
+      model: tf.Model object or scorer from proto_v2.scorers, decision model
+    Returns:
+      np.ndarray of scores
+    """
+    scorer = get_scorer(model)
+    x = preprocess_images(images, scorer.input_shape[1: 3])
+    return scorer.score(x)
+
+
+def sample_scorer_inputs(forms_root, size, count=32, img_size=(300, 300), fig_count=5, fig_size_range=(40, 60)):
+    """Generates random layouts and preprocesses them, used for scorer calibration and comparison
+    Args:
+      forms_root:
+      size: tuple, model input size
+      count: int, count of layouts
+      img_size: tuple, layouts size
+      fig_count: count of figures on each layout
+      fig_size_range: tuple, range of figure sizes
+    Returns:
+      np.ndarray batch
+    """
+    atlas = get_atlas(forms_root)
+    generator = ImageGenerator(atlas.get_paths(), img_size, fig_count, fig_size_range, atlas=atlas)
+    return preprocess_images([next(generator) for _ in range(count)], size)
+
+
+class LayoutMemo(object):
+    """Memoizes layout scores and keeps pools of accepted layouts for reuse
+
+    Args:
+      max_scores: int, max count of memoized scores
+      pool_size: int, max count of accepted layouts kept per pool
+      min_pool_size: int, pool size required to start reusing layouts
+      reuse_probability: float, probability to reuse accepted layout instead of searching for a new one
+      quantization: int, positions and sizes step in layout signatures, px
+      jitter: int, max shift of reused figures, px
+    """
+
+    def __init__(self, max_scores=65536, pool_size=32, min_pool_size=4, reuse_probability=0.5, quantization=4,
+                 jitter=4):
+        self.scores = LRUCache(max_scores)
+        self.pool_size = pool_size
+        self.min_pool_size = min_pool_size
+        self.reuse_probability = reuse_probability
+        self.quantization = quantization
+        self.jitter = jitter
+        self.reused = 0
+        self._pools = dict()
+        self._lock = threading.Lock()
+
+    def get_signature(self, img_size, layout):
+        q = self.quantization
+        return tuple(img_size), tuple(sorted((path, x // q, y // q, x_size // q, y_size // q)
+                                             for path, x, y, x_size, y_size in layout))
+
+    def add_accepted(self, pool_key, layout):
+        with self._lock:
+            if pool_key not in self._pools:
+                self._pools[pool_key] = deque(maxlen=self.pool_size)
+            if layout not in self._pools[pool_key]:
+                self._pools[pool_key].append(layout)
+
+    def sample_accepted(self, pool_key):
+        """Returns randomly jittered accepted layout or None if a new one should be searched for"""
+        with self._lock:
+            pool = list(self._pools.get(pool_key, ()))
+        if len(pool) < self.min_pool_size or np.random.random_sample() >= self.reuse_probability:
+            return None
+
+        layout = pool[np.random.randint(len(pool))]
+        return tuple((path, x + np.random.randint(-self.jitter, self.jitter + 1),
+                      y + np.random.randint(-self.jitter, self.jitter + 1), x_size, y_size)
+                     for path, x, y, x_size, y_size in layout), layout
+
+    def count_reused(self):
+        with self._lock:
+            self.reused += 1
+
+    def get_stats(self):
+        with self._lock:
+            pools = len(self._pools)
+        return {'score_hits': self.scores.hits, 'score_misses': self.scores.misses, 'reused_layouts': self.reused,
+                'pools': pools}
+
+
+LAYOUT_MEMO = LayoutMemo()
+
+
+class LayoutPrefilter(object):
+    """Cheap geometric check that rejects obviously bad layouts before scoring
+
+    Args:
+      max_center_offset: float, max distance between figures centroid and canvas center
+                         relative to half of canvas size
+      max_quadrant_share: float, max share of figures area in a single canvas quadrant (3+ figures only)
+      border_margin: int, min distance between figures and canvas border, px
+      attempts: int, count of candidates generated to find a plausible one
+    """
+
+    def __init__(self, max_center_offset=0.5, max_quadrant_share=0.75, border_margin=2, attempts=5):
+        self.max_center_offset = max_center_offset
+        self.max_quadrant_share = max_quadrant_share
+        self.border_margin = border_margin
+        self.attempts = attempts
+        self.passed = 0
+        self.pruned = 0
+        self._lock = threading.Lock()
+
+    def check(self, layout, img_size):
+        """
+        Args:
+          layout: tuple of (path, x, y, x_size, y_size) placements
+          img_size: tuple, canvas size
+        Returns:
+          boolean, True if layout is plausible
+        """
+        if not layout:
+            return True
+
+        boxes = np.array([placement[1:] for placement in layout], dtype=np.float64)
+        starts, sizes = boxes[:, :2], boxes[:, 2:]
+        ends = starts + sizes
+        canvas = np.array(img_size[:2], dtype=np.float64)
+
+        if (starts < self.border_margin).any() or (ends > canvas - self.border_margin).any():
+            return False
+
+        areas = sizes.prod(axis=1)
+        centroid = np.dot(areas, starts + sizes / 2) / areas.sum()
+        if (np.abs(centroid - canvas / 2) / (canvas / 2)).max() > self.max_center_offset:
+            return False
+
+        if len(layout) >= 3:
+            half = canvas / 2
+            # overlap of every figure with every quadrant along both axes
+            low = np.clip(np.minimum(ends, half) - starts, 0, None)
+            high = np.clip(ends - np.maximum(starts, half), 0, None)
+            quadrants = np.stack((low[:, 0] * low[:, 1], low[:, 0] * high[:, 1],
+                                  high[:, 0] * low[:, 1], high[:, 0] * high[:, 1])).sum(axis=1)
+            if quadrants.max() > self.max_quadrant_share * quadrants.sum():
+                return False
+
+        return True
+
+    def next_candidate(self, generator):
+        """Places figures until a layout passes the check and renders only that one
+
+        Returns:
+          PIL.Image or None if no layout passed in attempts, the caller skips the candidate then
+        """
+        for attempt in range(self.attempts):
+            image_grid = generator.get_random_grid()
+            if self.check(generator.get_last_layout(), generator.get_size()):
+                with self._lock:
+                    self.passed += 1
+                return image_grid.render_image()
+            with self._lock:
+                self.pruned += 1
+        return None
+
+    def get_stats(self):
+        return {'passed': self.passed, 'pruned': self.pruned}
+
+
+LAYOUT_PREFILTER = LayoutPrefilter()
+
+
+def generate_good_image(generator, model, threshold=0.5, batch_size=1, rounds=10, memo=None, pool_key=None,
+                        prefilter=None):
     """Generates compositionally well-done image
     Args:
       generator: ImageGenerator object, generator to user
-      model: tf.Model object, decision model
+      model: tf.Model object or scorer from proto_v2.scorers, decision model
       threshold: float between 0 and 1, which limits output image score
+      batch_size: int, count of candidates scored with one model call
+      rounds: int, max count of scored batches
+      memo: LayoutMemo, memoizes scores and reuses accepted layouts, disabled if None
+      pool_key: hashable, key of accepted layouts pool, layouts are not reused if None
+      prefilter: LayoutPrefilter, candidates rejected by it are not scored, disabled if None
     Returns:
-      tuple, (PIL.Image, float) - image and its score
+      PIL.Image, the first best candidate of a batch that passed threshold or the best candidate overall,
+      unchecked candidate if prefilter rejected all of them
     """
-    y_pred = 0
-    img = None
-    iterations = 0
+    if memo is not None and pool_key is not None:
+        reused = memo.sample_accepted(pool_key)
+        if reused is not None:
+            jittered, layout = reused
+            img = generator.render_layout(jittered)
+            if img is None:
+                img = generator.render_layout(layout)
+            if img is not None:
+                memo.count_reused()
+                return img
 
-    while y_pred < threshold:
-        iterations += 1
+    best_img, best_layout, best_score = None, None, -1
 
-        if iterations > 10:
-            break
+    for _ in range(rounds):
+        candidates, layouts = [], []
+        for _ in range(batch_size):
+            img = next(generator) if prefilter is None else prefilter.next_candidate(generator)
+            if img is not None:
+                candidates.append(img)
+                layouts.append(generator.get_last_layout())
+        if not candidates:
+            continue
 
-        img = next(generator)
-        x = alpha_to_color(img)
-        x = resize_image_with_pad(x, model.input_shape[1: 3])
-        x = np.array([np.array(x)])
-        x = preprocess_input(x)
-        y_pred = model.predict(x)[0][0]
+        scores = np.zeros(len(candidates))
+        unscored = list(range(len(candidates)))
 
-    return img
+        if memo is not None:
+            signatures = [memo.get_signature(generator.get_size(), layout) for layout in layouts]
+            cached = [memo.scores.get(signature) for signature in signatures]
+            unscored = [i for i, score in enumerate(cached) if score is None]
+            scores = np.array([0 if score is None else score for score in cached], dtype=np.float64)
+
+        if unscored:
+            scores[unscored] = score_images([candidates[i] for i in unscored], model)
+            if memo is not None:
+                for i in unscored:
+                    memo.scores.put(signatures[i], float(scores[i]))
+
+        best_idx = int(np.argmax(scores))
+        if scores[best_idx] > best_score:
+            best_img, best_layout, best_score = candidates[best_idx], layouts[best_idx], scores[best_idx]
+
+        if best_score >= threshold:
+            if memo is not None and pool_key is not None:
+                memo.add_accepted(pool_key, best_layout)
+            break
+
+    if best_img is None:
+        # every candidate was rejected by prefilter, an unchecked one is better than nothing
+        best_img = next(generator)
+    return best_img
 
 
 def generate_good_image_wrapped(img_size, model, forms_root, forms_type='all', fig_count=3, fig_size_range=(20, 65),
-                                threshold=0.75):
+                                threshold=0.75, batch_size=1, rounds=10, memo=LAYOUT_MEMO,
+                                prefilter=LAYOUT_PREFILTER, rng=None):
     """Generate good image function wrapper
     Args:
       img_size: tuple, image size
@@ -89,23 +321,23 @@ def generate_good_image_wrapped(img_size, model, forms_root, forms_type='all', f
       fig_size_range: tuple, range of figure sizes, default = (20, 65)
       model: keras.models.Sequential, scorer model
       threshold: float between 0 and 1, which limits output image score
+      batch_size: int, count of candidates scored with one model call
+      rounds: int, max count of scored batches
+      memo: LayoutMemo, process-wide by default, disabled if None or if rng is given
+      prefilter: LayoutPrefilter, process-wide by default, disabled if None
+      rng: np.random.RandomState, makes layouts reproducible, memo is not used with it
     Returns:
       PIL.Image, generated image
     """
 
-    if forms_type == 'c':
-        paths = [os.path.join(forms_root, x) for x in os.listdir(forms_root) if
-                 'cm' in x and os.path.isfile(os.path.join(forms_root, x))]
-    elif forms_type == 't':
-        paths = [os.path.join(forms_root, x) for x in os.listdir(forms_root) if
-                 'triangle' in x and 's' not in x and 'big' not in x and os.path.isfile(os.path.join(forms_root, x))]
-    else:
-        paths = [os.path.join(forms_root, x) for x in os.listdir(forms_root) if
-                 'big' not in x and os.path.isfile(os.path.join(forms_root, x))]
-
-    generator = ImageGenerator(paths, img_size, fig_count, fig_size_range)
+    atlas = get_atlas(forms_root)
+    generator = ImageGenerator(atlas.get_paths(forms_type), img_size, fig_count, fig_size_range, atlas=atlas, rng=rng)
 
-    img = generate_good_image(generator, model, threshold)
+    # memoized scores and accepted layouts depend on other sessions, so they would break reproducibility
+    if rng is not None:
+        memo = None
+    img = generate_good_image(generator, model, threshold, batch_size, rounds, memo,
+                              pool_key=(tuple(img_size), forms_type, fig_count), prefilter=prefilter)
 
     del model, generator  # TEMP, rewrite as class
 
@@ -1,30 +1,122 @@
+from functools import lru_cache
 from PIL import ImageFont, ImageDraw, Image
 import os
 
+from .caching import LRUCache
+
 FONT = 'muller.ttf'
 FONT_B = 'muller_b.ttf'
 FONT_L = 'muller_l.ttf'
 
+# rendered text layers keyed by all get_image_text arguments, bounded by RGBA pixel bytes
+TEXT_CACHE = LRUCache(128 * 1024 * 1024, size_fn=lambda value: value[0].width * value[0].height * 4)
+
+
+@lru_cache(maxsize=256)
+def get_font(font_filename, font_size):
+    """Returns process-wide FreeTypeFont object, fonts are parsed once per (path, size)"""
+    return ImageFont.truetype(font_filename, font_size)
+
 
+@lru_cache(maxsize=65536)
 def get_text_size(font_filename, font_size, text):
-    font = ImageFont.truetype(font_filename, font_size)
-    return font.getsize(text)
+    return get_font(font_filename, font_size).getsize(text)
 
 
 def get_font_size(text, font, max_width=None, max_height=None):
     if max_width is None and max_height is None:
         raise ValueError('You need to pass max_width or max_height')
-    font_size = 1
-    text_size = get_text_size(font, font_size, text)
+
+    def fits(font_size):
+        text_size = get_text_size(font, font_size, text)
+        return (max_width is None or text_size[0] < max_width) and \
+            (max_height is None or text_size[1] < max_height)
+
+    text_size = get_text_size(font, 1, text)
     if (max_width is not None and text_size[0] > max_width) or \
             (max_height is not None and text_size[1] > max_height):
         raise ValueError("Text can't be filled in only (%dpx, %dpx)" % text_size)
-    while True:
-        if (max_width is not None and text_size[0] >= max_width) or \
-                (max_height is not None and text_size[1] >= max_height):
-            return font_size - 1
-        font_size += 1
-        text_size = get_text_size(font, font_size, text)
+    if not fits(1):
+        return 0
+
+    # the largest fitting size lies in [low, high)
+    low, high = 1, 2
+    while fits(high):
+        low, high = high, high * 2
+    while high - low > 1:
+        middle = (low + high) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+def wrap_words(words, font_filename, font_size, box_width, box_height):
+    """Greedily wraps words into lines measuring every line as a whole
+
+    Returns:
+      list of lines (lists of words, some may be empty) and text height
+      or None if a line is wider than the box or lines are higher than it
+    """
+    lines = []
+    line = []
+    text_height = 0
+    for word in words:
+        size = get_text_size(font_filename, font_size, ' '.join(line + [word]))
+        text_height = size[1]
+        if size[0] <= box_width:
+            line.append(word)
+        else:
+            lines.append(line)
+            size = get_text_size(font_filename, font_size, ' '.join(line))
+            if (len(line) == 1 and size[0] > box_width) or len(lines) * text_height > box_height:
+                return None
+            line = [word]
+    size = get_text_size(font_filename, font_size, ' '.join(line))
+    text_height = size[1]
+    if size[0] > box_width or len(lines) * text_height > box_height:
+        return None
+    if line:
+        lines.append(line)
+    return lines, text_height
+
+
+def fit_text_box(text, box_width, box_height, font_filename, max_font_size, line_spacing=16,
+                 line_spacing_coef=0.2):
+    """Finds the largest font size not above max_font_size that fits wrapped text into the box
+
+    Sizes are binary searched instead of being decremented one by one, then the font is shrunk
+    while lines with spacing are higher than the box and line_spacing is recomputed from the final size.
+
+    Returns:
+      font size, list of lines, text height, line spacing
+    """
+    words = text.split()
+
+    low, high = 1, max_font_size
+    result = wrap_words(words, font_filename, high, box_width, box_height)
+    if result is not None:
+        low = high
+    else:
+        while high - low > 1:
+            middle = (low + high) // 2
+            if wrap_words(words, font_filename, middle, box_width, box_height) is not None:
+                low = middle
+            else:
+                high = middle
+        result = wrap_words(words, font_filename, low, box_width, box_height)
+        if result is None:
+            # text can't fit even with the smallest font, it is drawn as is
+            result = [words], get_text_size(font_filename, low, text)[1]
+
+    font_size = low
+    lines, text_height = result
+    while len(lines) * text_height + (len(lines) - 1) * line_spacing > box_height:
+        text_height = get_text_size(font_filename, font_size, text)[1]
+        font_size -= 1
+        line_spacing = round(font_size * line_spacing_coef)
+    return font_size, [' '.join(line) for line in lines if line], text_height, line_spacing
 
 
 class ImageText(object):
@@ -49,7 +141,7 @@ class ImageText(object):
         if font_size == 'fill' and (max_width is not None or max_height is not None):
             font_size = get_font_size(text, font_filename, max_width, max_height)
         text_size = get_text_size(font_filename, font_size, text)
-        font = ImageFont.truetype(font_filename, font_size)
+        font = get_font(font_filename, font_size)
         if x == 'center':
             x = (self.size[0] - text_size[0]) / 2
         if y == 'center':
@@ -58,41 +150,9 @@ class ImageText(object):
 
     def write_text_box(self, x, y, text, box_width, box_height, font_filename, line_spacing=16,
                        font_size=72, line_spacing_coef=0.2, color=(0, 0, 0), place='left', justify_last_line=False):
-        words = text.split()
-        while True:
-            lines = []
-            line = []
-            lines_sizes = []
-            fitting_failed = False
-            for word in words:
-                new_line = ' '.join(line + [word])
-                size = get_text_size(font_filename, font_size, new_line)
-                text_height = size[1]
-                if size[0] <= box_width:
-                    line.append(word)
-                else:
-                    lines.append(line)
-                    size = get_text_size(font_filename, font_size, ' '.join(line))
-                    if (len(line) == 1 and size[0] > box_width) or len(lines) * text_height > box_height:
-                        font_size -= 1
-                        fitting_failed = True
-                        break
-                    line = [word]
-            size = get_text_size(font_filename, font_size, ' '.join(line))
-            text_height = size[1]
-            if fitting_failed:
-                continue
-            if size[0] > box_width or len(lines) * text_height > box_height:
-                font_size -= 1
-                continue
-            if line:
-                lines.append(line)
-            break
-        while len(lines) * text_height + (len(lines) - 1) * line_spacing > box_height:
-            text_height = get_text_size(font_filename, font_size, text)[1]
-            font_size -= 1
-            line_spacing = round(font_size * line_spacing_coef)
-        lines = [' '.join(line) for line in lines if line]
+        lines_sizes = []
+        font_size, lines, text_height, line_spacing = fit_text_box(text, box_width, box_height, font_filename,
+                                                                   font_size, line_spacing, line_spacing_coef)
         height = y - line_spacing - text_height
         for index, line in enumerate(lines):
             size = get_text_size(font_filename, font_size, line)
@@ -129,6 +189,23 @@ class ImageText(object):
 
 def get_image_text(width, height, text, fonts_root, font_type='b', max_font_size=70, place='left',
                    color=(128, 128, 128), offset=0, line_spacing_coef=0.2, bg_color=(0, 0, 0)):
+    """Returns rendered text layer, layers are cached in TEXT_CACHE and must not be modified by callers
+
+    Arguments are the same as in render_image_text.
+    """
+    key = (width, height, text, fonts_root, font_type, max_font_size, place, tuple(color), offset,
+           line_spacing_coef, tuple(bg_color))
+    cached = TEXT_CACHE.get(key)
+    if cached is None:
+        cached = render_image_text(width, height, text, fonts_root, font_type, max_font_size, place, color, offset,
+                                   line_spacing_coef, bg_color)
+        TEXT_CACHE.put(key, cached)
+    image, lines_sizes = cached
+    return image, list(lines_sizes)
+
+
+def render_image_text(width, height, text, fonts_root, font_type='b', max_font_size=70, place='left',
+                      color=(128, 128, 128), offset=0, line_spacing_coef=0.2, bg_color=(0, 0, 0)):
     """Args:
           width (:obj:`int`): Width of the image_text.
           height (:obj:`int`): Height of the image_text.
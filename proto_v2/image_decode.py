@@ -0,0 +1,56 @@
+from io import BytesIO
+from PIL import Image
+
+
+def check_image(image_bytes):
+    """Parses image header without decoding pixels
+
+    Returns:
+      (width, height) of image
+    Raises:
+      IOError if bytes are not a supported image
+    """
+    image = Image.open(BytesIO(image_bytes))
+    if min(image.size) == 0:
+        raise IOError('empty image')
+    return image.size
+
+
+class DecodedImage(object):
+    """Decodes uploaded image once and derives all images needed for analysis from it
+
+    Attributes:
+      image: PIL.Image, working image with the smaller side equal to `basesize`
+      model_input: PIL.Image, RGB image with the larger side equal to `model_input_size`
+      palette_image: PIL.Image, small RGB image for palette extraction
+    """
+
+    def __init__(self, image_bytes, basesize=1080, model_input_size=513, palette_size=200):
+        image = Image.open(BytesIO(image_bytes))
+
+        # JPEG decoder is able to downscale by 2, 4 or 8 while decoding
+        draft_ratio = basesize / float(min(image.size[:2]))
+        if draft_ratio < 1:
+            image.draft(None, (int(image.size[0] * draft_ratio), int(image.size[1] * draft_ratio)))
+
+        self.image = self.resize_to_basesize(image, basesize)
+        self.model_input = self.resize_to_max_side(self.image.convert('RGB'), model_input_size)
+        self.palette_image = self.resize_to_max_side(self.model_input, palette_size)
+
+    @staticmethod
+    def resize_to_basesize(image, basesize):
+        wpercent = (basesize / float(min(image.size[:2])))
+        hsize = int((float(max(image.size[:2])) * float(wpercent)))
+        if image.size[0] < image.size[1]:
+            return image.resize((basesize, hsize), Image.ANTIALIAS)
+        else:
+            return image.resize((hsize, basesize), Image.ANTIALIAS)
+
+    @staticmethod
+    def resize_to_max_side(image, size):
+        width, height = image.size
+        resize_ratio = 1.0 * size / max(width, height)
+        target_size = (int(resize_ratio * width), int(resize_ratio * height))
+        if target_size == image.size:
+            return image
+        return image.resize(target_size, Image.ANTIALIAS)
@@ -1,3 +1,4 @@
+import numpy as np
 from PIL import ImageEnhance
 
 
@@ -49,6 +50,74 @@ class Enhancer:
         return img
 
 
+class MaskStats(object):
+    """Statistics of key objects mask computed once per mask
+
+    Attributes:
+      shape: mask shape
+      area: count of nonzero mask pixels
+      bbox: [min row, max row, min column, max column] of nonzero pixels, whole mask if it is empty
+      centroid: (row, column) mean of nonzero coordinates, mask center if it is empty
+      scale: scale of image to mask
+      obj_coordinates: object bounds along the larger image side
+      image_crop_points, mask_crop_points: upper left points of thirds for image and mask
+      crop_masks: tuple of uint8 masks (0 or 255) croped by thirds
+    """
+
+    def __init__(self, mask, image_size, basesize=1080):
+        self.shape = mask.shape
+        self.basesize = basesize
+
+        nonzero = mask != 0
+        row_counts = np.count_nonzero(nonzero, axis=1)
+        column_counts = np.count_nonzero(nonzero, axis=0)
+        self.area = int(row_counts.sum())
+
+        if self.area:
+            rows, columns = row_counts.nonzero()[0], column_counts.nonzero()[0]
+            self.bbox = [int(rows[0]), int(rows[-1]), int(columns[0]), int(columns[-1])]
+            self.centroid = (float(np.dot(row_counts, np.arange(mask.shape[0]))) / self.area,
+                             float(np.dot(column_counts, np.arange(mask.shape[1]))) / self.area)
+        else:
+            self.bbox = [0, 0, mask.shape[0], mask.shape[1]]
+            self.centroid = (mask.shape[0] / 2, mask.shape[1] / 2)
+
+        self.scale = max(image_size) / max(mask.shape)
+        self.is_landscape = image_size[0] >= image_size[1]
+        self.obj_coordinates = self.bbox[2:] if self.is_landscape else self.bbox[:2]
+
+        self.image_crop_points = get_points([int(x * self.scale) for x in self.obj_coordinates], image_size,
+                                            basesize)
+        self.mask_crop_points = get_points(self.obj_coordinates, (mask.shape[1], mask.shape[0]),
+                                           int(basesize / self.scale))
+
+        binary = nonzero.astype(np.uint8) * 255
+        self.crop_masks = tuple(binary[mask_slice] for mask_slice in self.get_mask_slices())
+
+    def get_mask_slices(self):
+        """
+        Return:
+          tuple of (rows slice, columns slice) of mask thirds
+        """
+        scaled_basesize = int(self.basesize / self.scale)
+        if self.shape[1] >= self.shape[0]:
+            return tuple((slice(0, scaled_basesize), slice(point, point + scaled_basesize))
+                         for point in self.mask_crop_points)
+        else:
+            return tuple((slice(point, point + scaled_basesize), slice(0, scaled_basesize))
+                         for point in self.mask_crop_points)
+
+    def get_image_boxes(self):
+        """
+        Return:
+          tuple of PIL crop boxes of image thirds
+        """
+        if self.is_landscape:
+            return tuple((point, 0, point + self.basesize, self.basesize) for point in self.image_crop_points)
+        else:
+            return tuple((0, point, self.basesize, point + self.basesize) for point in self.image_crop_points)
+
+
 def get_mean(mask):
     """
      Parameters:
@@ -56,17 +125,10 @@ def get_mean(mask):
      Return:
        mean value of all nonzero coordinates  
      """
-    mean = None
-    for x in range(mask.shape[0]):
-        for y in range(mask.shape[1]):
-            if mask[x][y] > 0:
-                if mean:
-                    mean = ((mean[0] + x) / 2, (mean[1] + y) / 2)
-                else:
-                    mean = (int(x), int(y))
-    if not mean:
-        mean = (1080 // 2, 1080 // 2)
-    return mean
+    nonzero_indices = mask.nonzero()
+    if nonzero_indices[0].size == 0:
+        return 1080 // 2, 1080 // 2
+    return nonzero_indices[0].mean(), nonzero_indices[1].mean()
 
 
 def get_scale(img, mask):
@@ -86,6 +148,10 @@ def get_object_coordinates(object_mask):
     return [nonzero_indices[0].min(), nonzero_indices[0].max(), nonzero_indices[1].min(), nonzero_indices[1].max()]
 
 
+# count of thirds image and mask are croped to by crop_by_sqare
+CROP_COUNT = 3
+
+
 def get_points(obj_coordinates, size, basesize):
     """
     Parameters:
@@ -93,7 +159,7 @@ def get_points(obj_coordinates, size, basesize):
       size: size of image or mask
       basesize
     Return:
-      three upper left point of thirds 
+      CROP_COUNT upper left points of thirds
     """
     first = obj_coordinates[0] + basesize // 20
     mid = obj_coordinates[0] / 2
@@ -115,7 +181,7 @@ def get_points(obj_coordinates, size, basesize):
     return int(first), int(mid), int(third)
 
 
-def crop_by_sqare(mask, coordinates=None, img=None, scale=1, basesize=1080):
+def crop_by_sqare(mask, coordinates=None, img=None, scale=1, basesize=1080, stats=None):
     """
     Parameters:
       coordinates:
@@ -123,10 +189,15 @@ def crop_by_sqare(mask, coordinates=None, img=None, scale=1, basesize=1080):
       mask
       img (optioal): optioal
       scale: scale of image to mask
+      stats (optional): MaskStats of mask, crop points are taken from it
     Return:
-      tuple of images croped by thirds
+      tuple of CROP_COUNT images croped by thirds
     """
-    mean = get_mean(mask)
+    if stats is not None:
+        if img is not None:
+            return tuple(img.crop(box) for box in stats.get_image_boxes())
+        return tuple(mask[mask_slice] for mask_slice in stats.get_mask_slices())
+
     if img is not None:
         coordinates = [int(x * scale) for x in coordinates]
         first, mid, third = get_points(coordinates, img.size[:2],  basesize)
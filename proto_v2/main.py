@@ -1,72 +1,241 @@
-import io
+import hashlib
+import itertools
+import numpy as np
 import random
+import threading
 from functools import partial
-from proto_v2 import comp_colors, image_enhance, patterns, segmentation
-from PIL import Image
-import time
+from proto_v2 import comp_colors, image_decode, image_enhance, patterns, segmentation, snapshot
+
+
+class stage(object):
+    """Lazily computed GenImage attribute
+
+    Value is computed on first access after all required stages and is stored in the instance dict, so later
+    accesses are plain attribute lookups and assignments override it. Stages are computed under the per-instance
+    lock, so parallel generation jobs compute every stage once.
+
+    Args:
+      requires: names of stages which are computed before this one
+    """
+
+    def __init__(self, *requires):
+        self.requires = requires
+        self.method = None
+        self.name = None
+
+    def __call__(self, method):
+        self.method = method
+        self.name = method.__name__
+        self.__doc__ = method.__doc__
+        return self
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        with instance.stages_lock:
+            if self.name not in instance.__dict__:
+                for name in self.requires:
+                    getattr(instance, name)
+                instance.__dict__[self.name] = self.method(instance)
+        return instance.__dict__[self.name]
 
 
 class GenImage:
-    def __init__(self, image_bytes, model, forms_root, fonts_root, seg_model, text=None):
+    # stages computed by analyze(), patterns trigger only the stages they use
+    ANALYSIS_STAGES = ('image', 'mask_stats', 'croped_images', 'croped_masks', 'empty_areas', 'comp_colors')
+
+    def __init__(self, image_bytes, model, forms_root, fonts_root, seg_model, text=None, mask_cache=None):
         self.text = text
         self.basesize = 1080
         self.image_bytes = image_bytes
-        self.image = Image.open(io.BytesIO(image_bytes))
         self.seg_model = seg_model
+        self.mask_cache = mask_cache
         self.forms_root = forms_root
         self.fonts_root = fonts_root
+        self.stages_lock = threading.RLock()
 
-        wpercent = (self.basesize / float(min(self.image.size[:2])))
-        hsize = int((float(max(self.image.size[:2])) * float(wpercent)))
-        if self.image.size[0] < self.image.size[1]:
-            self.image = self.image.resize((self.basesize, hsize), Image.ANTIALIAS)
-        else:
-            self.image = self.image.resize((hsize, self.basesize), Image.ANTIALIAS)
-
-        self.mask = None
         self.original_image = None
 
-        self.enhancer = image_enhance.Enhancer(self.image)
         self.enhancer_factors = {'britness_factor': 1,
                                  'contrast_factor': 1,
                                  'color_factor': 1,
                                  'sharpness_factor': 1}
 
-        self.generate_image_mask()
-
-        self.croped_images = None
-        self.croped_masks = None
-        self.empty_areas = None
         self.faces_on_croped = None
-        self.comp_colors = None
-        self.scale = image_enhance.get_scale(self.image, self.mask)
+        self.comp_colors_by_count = dict()
+        self.model = model
 
-        obj_coordinates = image_enhance.get_object_coordinates(self.mask)
-        if self.image.size[1] > self.image.size[0]:
-            self.obj_coordinates = obj_coordinates[:2]
-        else:
-            self.obj_coordinates = obj_coordinates[2:]
+    @stage()
+    def decoded(self):
+        return image_decode.DecodedImage(self.image_bytes, self.basesize,
+                                         model_input_size=segmentation.DeepLabModel.INPUT_SIZE)
 
-        self.crop_image()
-        self.get_empty_areas_on_croped(5)
-        # self.det_faces()
-        self.get_comp_colors()
-        self.model = model
+    @stage('decoded')
+    def image(self):
+        return self.decoded.image
+
+    @stage('image')
+    def enhancer(self):
+        return image_enhance.Enhancer(self.image)
+
+    @stage('decoded')
+    def mask(self):
+        return self.generate_image_mask()
+
+    @stage('mask', 'decoded')
+    def mask_stats(self):
+        return image_enhance.MaskStats(self.mask, self.decoded.image.size, self.basesize)
+
+    @stage('mask_stats')
+    def scale(self):
+        return self.mask_stats.scale
+
+    @stage('mask_stats')
+    def obj_coordinates(self):
+        return self.mask_stats.obj_coordinates
+
+    @stage('mask_stats', 'image')
+    def croped_images(self):
+        return image_enhance.crop_by_sqare(mask=self.mask, img=self.image, stats=self.mask_stats)
+
+    @stage('mask_stats')
+    def croped_masks(self):
+        return image_enhance.crop_by_sqare(mask=self.mask, stats=self.mask_stats)
+
+    @stage('croped_masks', 'scale')
+    def empty_areas(self):
+        return [segmentation.get_empty_areas(cr, 5, self.scale) for cr in self.croped_masks]
+
+    @stage('decoded')
+    def comp_colors(self):
+        return self.get_comp_colors()
+
+    def analyze(self):
+        """Computes all analysis stages at once instead of on first use"""
+        for name in self.ANALYSIS_STAGES:
+            getattr(self, name)
+        return self
+
+    def to_snapshot(self):
+        """Serializes image analysis, it is restored by from_snapshot without running any models
+
+        Snapshot is npz with bit-packed mask and JSON header with the rest of analysis.
+
+        Return:
+          bytes
+        """
+        self.analyze()
+        header = {'image_sha256': hashlib.sha256(self.image_bytes).hexdigest(),
+                  'seg_model': getattr(self.seg_model, 'model_id', None),
+                  'basesize': self.basesize,
+                  'image_size': list(self.decoded.image.size),
+                  'mask_shape': list(self.mask.shape),
+                  'scale': self.scale,
+                  'obj_coordinates': [int(x) for x in self.obj_coordinates],
+                  'empty_areas': [[[[int(x) for x in pos], [int(x) for x in size]] for pos, size in areas]
+                                  for areas in self.empty_areas],
+                  'comp_colors': {str(n_colors): [[int(x) for x in color] for color in colors]
+                                  for n_colors, colors in self.comp_colors_by_count.items()}}
+        return snapshot.dump(header, {'mask': snapshot.pack_mask(self.mask)})
+
+    @classmethod
+    def from_snapshot(cls, data, image_bytes, model, forms_root, fonts_root, seg_model=None, text=None,
+                      mask_cache=None):
+        """Restores GenImage analyzed by to_snapshot, only decoding and cropping of the image are left to do
+
+        Args:
+          data: bytes, snapshot
+          image_bytes: bytes, the image snapshot was made for
+          seg_model: segmentation model, the one snapshot was made with
+        Raises:
+          ValueError if snapshot is invalid, has unsupported version or was made for another image or seg_model
+        """
+        header, arrays = snapshot.load(data)
+        if header.get('image_sha256') != hashlib.sha256(image_bytes).hexdigest():
+            raise ValueError('snapshot was made for another image')
+        if header.get('seg_model') != getattr(seg_model, 'model_id', None):
+            raise ValueError(f'snapshot was made with segmentation model {header.get("seg_model")}')
+
+        gen_image = cls(image_bytes, model, forms_root, fonts_root, seg_model, text, mask_cache)
+        gen_image.basesize = header['basesize']
+        gen_image.mask = snapshot.unpack_mask(arrays['mask'], tuple(header['mask_shape']))
+        gen_image.mask_stats = image_enhance.MaskStats(gen_image.mask, tuple(header['image_size']),
+                                                       gen_image.basesize)
+        gen_image.scale = header['scale']
+        gen_image.obj_coordinates = header['obj_coordinates']
+        gen_image.croped_masks = image_enhance.crop_by_sqare(mask=gen_image.mask, stats=gen_image.mask_stats)
+        gen_image.empty_areas = [[(tuple(pos), tuple(size)) for pos, size in areas] for areas in header['empty_areas']]
+        gen_image.comp_colors_by_count = {int(n_colors): [tuple(color) for color in colors]
+                                          for n_colors, colors in header['comp_colors'].items()}
+        return gen_image
+
+    def get_generation_jobs(self):
+        """
+        Return:
+          list of independent (pattern, crop) jobs in output order, every job returns a list of images
+        """
+        # crops count is fixed, so building jobs doesn't compute any analysis stage
+        crop_indices = range(image_enhance.CROP_COUNT)
+        jobs = []
+        jobs.extend(partial(patterns.gen_simple_pattern, self, crop_indices=[i]) for i in crop_indices)
+        jobs.extend(partial(patterns.gen_simple_pattern, self, with_mask=True, crop_indices=[i]) for i in crop_indices)
+        jobs.append(partial(patterns.create_pattern_vacancy, self.text, self.forms_root, self.fonts_root))
+        jobs.extend(partial(patterns.create_pattern_checkmarks, self, crop_indices=[i]) for i in crop_indices)
+        jobs.append(partial(patterns.create_pattern_header_at_top_checkmarks, self.text, self.forms_root,
+                            self.fonts_root))
+        jobs.append(partial(patterns.gen_interview_pattern, self))
+        jobs.append(partial(patterns.gen_interview_pattern, self, pattern_type='color'))
+        # jobs.append(partial(patterns.create_pattern_vacancy_description, self.text))
+        return jobs
+
+    def generate(self, executor=None):
+        """
+        Args:
+          executor: concurrent.futures.Executor, runs generation jobs in parallel, jobs run sequentially if None
+        Return:
+          list of generated images
+        """
+        jobs = self.get_generation_jobs()
+        if executor is None:
+            results = [job() for job in jobs]
+        else:
+            results = [future.result() for future in [executor.submit(job) for job in jobs]]
 
-    def generate(self):
         all_results = []
-        all_results.extend(patterns.gen_simple_pattern(self))
-        all_results.extend(patterns.gen_simple_pattern(self, with_mask=True))
-        all_results.extend(patterns.create_pattern_vacancy(self.text, self.forms_root, self.fonts_root))
-        all_results.extend(patterns.create_pattern_checkmarks(self))
-        all_results.extend(patterns.create_pattern_header_at_top_checkmarks(self.text, self.forms_root,
-                                                                            self.fonts_root))
-        all_results.extend(patterns.gen_interview_pattern(self))
-        all_results.extend(patterns.gen_interview_pattern(self, pattern_type='color'))
-        # all_results.extend(create_pattern_vacancy_description(self.text))
+        for images in results:
+            all_results.extend(images)
         return all_results
 
-    def generate_image_by_image(self, israndom=False):
+    def render_image(self, index, seed):
+        """Renders image number `index` of the seeded image sequence
+
+        Every image is rendered by its own generation job with random state derived from (seed, cycle, job), so
+        analysis, text, seed and index fully determine the image.
+
+        Args:
+          index: int, image number
+          seed: int, session seed in [0, 2**32)
+        Return:
+          PIL.Image
+        """
+        jobs = self.get_generation_jobs()
+        cycle, job_index = divmod(index, len(jobs))
+        job = jobs[job_index]
+        if getattr(job.func, 'photo_independent', False):
+            return job()[0]
+        return job(rng=np.random.RandomState([seed, cycle, job_index]))[0]
+
+    def generate_image_by_image(self, israndom=False, seed=None, start=0):
+        """
+        Args:
+          israndom: bool, patterns are chosen randomly, ignored if seed is given
+          seed: int, yields reproducible images of render_image starting from `start`
+          start: int, index of the first seeded image
+        """
+        if seed is not None:
+            for index in itertools.count(start):
+                yield self.render_image(index, seed)
+
         generation_patterns = [partial(patterns.gen_simple_pattern, self),
                                partial(patterns.gen_simple_pattern, self, with_mask=True),
                                partial(patterns.create_pattern_vacancy, text=self.text, forms_root=self.forms_root,
@@ -102,11 +271,10 @@ class GenImage:
         self.enhancer_factors['sharpness_factor'] = sharpness_factor
 
     def get_comp_colors(self, n_colors=4):
-        self.comp_colors = []
-        gcc = comp_colors.get_complement_colors(io.BytesIO(self.image_bytes), n_colors)
-        base_colors = [(0, 170, 19), (255, 117, 0),
-                       (151, 215, 0), (255, 198, 0), (224, 0, 77)]
-        self.comp_colors = comp_colors.get_based_colors(base_colors, gcc)
+        if n_colors not in self.comp_colors_by_count:
+            gcc = comp_colors.get_complement_colors(self.decoded.palette_image, n_colors)
+            self.comp_colors_by_count[n_colors] = comp_colors.get_based_colors(comp_colors.BASE_COLORS, gcc)
+        self.comp_colors = list(self.comp_colors_by_count[n_colors])
         return self.comp_colors
 
     def generate_image_mask(self):
@@ -114,14 +282,22 @@ class GenImage:
         Return:
           mask of key objects
         """
-        _, self.mask = segmentation.seg(self.image_bytes, self.seg_model)
+        if self.mask_cache is not None:
+            self.mask = self.mask_cache.get(self.image_bytes, self.seg_model.model_id)
+            if self.mask is not None:
+                return self.mask
+
+        _, seg_map = segmentation.seg(self.decoded.model_input, self.seg_model)
+        # masks are uint8 like the cached ones whether they come from the model or from the cache
+        self.mask = np.asarray(seg_map).astype(np.uint8)
+
+        if self.mask_cache is not None:
+            self.mask_cache.put(self.image_bytes, self.seg_model.model_id, self.mask)
         return self.mask
 
     def crop_image(self):
-        self.croped_images = image_enhance.crop_by_sqare(mask=self.mask, coordinates=self.obj_coordinates,
-                                                         img=self.image, scale=self.scale)
-        self.croped_masks = image_enhance.crop_by_sqare(mask=self.mask, coordinates=self.obj_coordinates,
-                                                        scale=self.scale)
+        self.croped_images = image_enhance.crop_by_sqare(mask=self.mask, img=self.image, stats=self.mask_stats)
+        self.croped_masks = image_enhance.crop_by_sqare(mask=self.mask, stats=self.mask_stats)
 
     def get_empty_areas_on_croped(self, count):
         self.empty_areas = []
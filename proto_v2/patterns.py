@@ -1,19 +1,69 @@
+from functools import wraps
+import inspect
+import io
 from PIL import ImageFilter
 from .font_drawing import *
 from .evaluatablegeneration_v2 import *
-import random
+from .assets import get_assets
+from .caching import LRUCache
+
+# results of photo-independent patterns keyed by (pattern, arguments), images carry their PNG bytes
+STATIC_PATTERN_CACHE = LRUCache(64 * 1024 * 1024,
+                                size_fn=lambda images: sum(image.width * image.height * 4 + len(image.encoded_png)
+                                                           for image in images))
+
+
+def encode_png(image):
+    """Returns PNG bytes of image, bytes of photo-independent pattern results are encoded once"""
+    encoded = getattr(image, 'encoded_png', None)
+    if encoded is not None:
+        return encoded
+
+    img_arr = io.BytesIO()
+    image.save(img_arr, 'PNG')
+    return img_arr.getvalue()
+
+
+def photo_independent(pattern):
+    """Marks pattern which depends only on its hashable arguments, not on the photo
+
+    Results are cached with their PNG bytes and shared between callers, so they must not be modified.
+    """
+    signature = inspect.signature(pattern)
+
+    @wraps(pattern)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        key = (pattern.__name__, tuple(arguments.arguments.items()))
+
+        results = STATIC_PATTERN_CACHE.get(key)
+        if results is None:
+            results = pattern(*args, **kwargs)
+            for image in results:
+                # copies don't inherit the attribute, so modified copies are encoded again
+                image.encoded_png = encode_png(image)
+            STATIC_PATTERN_CACHE.put(key, results)
+        return list(results)
+
+    wrapper.photo_independent = True
+    return wrapper
 
 
 def gen_simple_pattern(genImage, with_mask=False, text_size=(860, 64),
                        color=(0, 0, 0), text_outline_offset=0,
                        max_font_size=72, text_pos_x=100, max_fill=0.5,
-                       threshold=0.6):
+                       threshold=0.6, scorer_batch_size=4, scorer_rounds=3, crop_indices=None, rng=None):
     results = []
     text = genImage.text
     model = genImage.model
+    random_state = np.random if rng is None else rng
 
-    crop_index = 0
-    for used_img, used_mask in zip(genImage.croped_images, genImage.croped_masks):
+    if crop_indices is None:
+        crop_indices = range(len(genImage.croped_images))
+
+    for crop_index in crop_indices:
+        used_img = genImage.croped_images[crop_index]
         result = used_img.copy()
 
         if with_mask:
@@ -21,21 +71,21 @@ def gen_simple_pattern(genImage, with_mask=False, text_size=(860, 64),
                                        (255, 198, 0): 'yel', (224, 0, 77): 'cr'}
 
             colors = []
-            for color in genImage.comp_colors:
+            for color in genImage.get_comp_colors():
                 colors.append((color, rgb_to_text_translation[color]))
-            random.shuffle(colors)
+            random_state.shuffle(colors)
 
             bg_color, mask_color = colors[0][0], colors[0][1]
 
             bg = Image.new('RGBA', (1080, 1080), bg_color)
-            form = Image.open(os.path.join(genImage.forms_root, f'1/mask_{mask_color}.png'))
-            x, y = np.random.randint(0, 100), np.random.randint(550, 650)
-            crop_size = np.random.randint(450, 700)
+            form = get_assets(genImage.forms_root).get(f'1/mask_{mask_color}.png')
+            x, y = random_state.randint(0, 100), random_state.randint(550, 650)
+            crop_size = random_state.randint(450, 700)
             cropped = form.crop((0, y, crop_size, y + crop_size)).resize((1080, 1080))
             bg.paste(cropped, box=(x, 0))
 
-            used_mask[used_mask != 0] = 255
-            filtered_mask = Image.fromarray(used_mask.astype(np.uint8)).resize((1080, 1080)).filter(ImageFilter.SMOOTH)
+            filtered_mask = Image.fromarray(genImage.mask_stats.crop_masks[crop_index]).resize((1080, 1080)).filter(
+                ImageFilter.SMOOTH)
 
             result.paste(bg, mask=bg)
             result.paste(used_img, mask=filtered_mask)
@@ -56,7 +106,7 @@ def gen_simple_pattern(genImage, with_mask=False, text_size=(860, 64),
             if fig_cnt < 2:
                 continue
 
-            if random.random() < max_fill:
+            if random_state.random_sample() < max_fill:
                 new_areas.append([(pos_x, pos_y), (size_x, size_y), (min_fig_size, max_fig_size, fig_cnt)])
 
         forms = []
@@ -68,7 +118,10 @@ def gen_simple_pattern(genImage, with_mask=False, text_size=(860, 64),
                 fig_count=fig_cnt,
                 forms_type='a',
                 fig_size_range=(min_fig_size, max_fig_size),
-                threshold=threshold))
+                threshold=threshold,
+                batch_size=scorer_batch_size,
+                rounds=scorer_rounds,
+                rng=rng))
 
         img_text, text_box = get_interview_image_text(text, genImage.fonts_root, text_y_offset=1)
 
@@ -77,7 +130,6 @@ def gen_simple_pattern(genImage, with_mask=False, text_size=(860, 64),
         result.paste(img_text, (text_pos_x, text_box[1]-50), mask=img_text)
 
         results.append(result)
-        crop_index += 1
 
     return results
 
@@ -108,10 +160,12 @@ def find_lower_bound_of_text(lines_sizes, line_spacing):
     return lower_bound
 
 
+@photo_independent
 def create_pattern_vacancy(text, forms_root, fonts_root):
+    assets = get_assets(forms_root)
     result = Image.new("RGBA", (1080, 1080))
-    bg = Image.open(os.path.join(forms_root, '1/vacancy_bg.png'))
-    vacancy = Image.open(os.path.join(forms_root, '1/vacancy.png'))
+    bg = assets.get('1/vacancy_bg.png')
+    vacancy = assets.get('1/vacancy.png')
     img_text, lines_sizes = get_image_text(960, 450, text, fonts_root, font_type='b', color=(255, 255, 255),
                                            max_font_size=200)
 
@@ -124,7 +178,7 @@ def create_pattern_vacancy(text, forms_root, fonts_root):
     return [result]
 
 
-def create_pattern_vacancy_description(text, forms_root, fonts_root):
+def create_pattern_vacancy_description(text, forms_root, fonts_root, rng=None):
     """Args:
         text (:obj:`list`): Title of the text and the text itself.
         forms_root:
@@ -139,8 +193,7 @@ def create_pattern_vacancy_description(text, forms_root, fonts_root):
                                            max_font_size=64)
     result.paste(img_text, mask=img_text, box=(90, 110))
 
-    marker = Image.open(os.path.join(forms_root, 'cm_r_yel.png'))
-    marker.thumbnail((29, 46))
+    marker = get_assets(forms_root).get('cm_r_yel.png', (29, 46), thumbnail=True)
     lower_bound = 255
 
     for i in text[1:]:
@@ -153,15 +206,15 @@ def create_pattern_vacancy_description(text, forms_root, fonts_root):
         lower_bound += find_lower_bound_of_text(lines_sizes, line_spacing)
         lower_bound += 64
 
-    color = random.choice(["cr", "lg", "mg", "mo", "yel"])
-    cm = Image.open(os.path.join(forms_root, f'cm_r_{color}.png'))
-    cm.thumbnail((69, 110))
+    rng = np.random if rng is None else rng
+    color = ["cr", "lg", "mg", "mo", "yel"][rng.randint(5)]
+    cm = get_assets(forms_root).get(f'cm_r_{color}.png', (69, 110), thumbnail=True)
     result.paste(cm, mask=cm, box=(951, 910))
 
     return [result]
 
 
-def create_triple_checkmarks(comp_colors, forms_root):
+def create_triple_checkmarks(comp_colors, forms_root, rng=None):
     result = Image.new("RGBA", (136, 195))
 
     rgb_to_text_translation = {(0, 170, 19): 'mg', (255, 117, 0): 'mo', (151, 215, 0): 'lg', (255, 198, 0): 'yel',
@@ -170,29 +223,31 @@ def create_triple_checkmarks(comp_colors, forms_root):
     colors = []
     for color in comp_colors:
         colors.append(rgb_to_text_translation[color])
-    random.shuffle(colors)
+    rng = np.random if rng is None else rng
+    rng.shuffle(colors)
 
-    cm1 = Image.open(os.path.join(forms_root, f'cm_r_{colors[0]}.png'))
-    cm1.thumbnail((27, 43))
+    assets = get_assets(forms_root)
+    cm1 = assets.get(f'cm_r_{colors[0]}.png', (27, 43), thumbnail=True)
     result.paste(cm1, mask=cm1, box=(40, 0))
 
-    cm2 = Image.open(os.path.join(forms_root, f'cm_l_{colors[1]}.png'))
-    cm2.thumbnail((40, 65))
+    cm2 = assets.get(f'cm_l_{colors[1]}.png', (40, 65), thumbnail=True)
     result.paste(cm2, mask=cm2, box=(95, 52))
 
-    cm3 = Image.open(os.path.join(forms_root, f'cm_r_{colors[2]}.png'))
-    cm3.thumbnail((54, 86))
+    cm3 = assets.get(f'cm_r_{colors[2]}.png', (54, 86), thumbnail=True)
     result.paste(cm3, mask=cm3, box=(0, 109))
 
     return result
 
 
-def create_pattern_checkmarks(genImage):
+def create_pattern_checkmarks(genImage, crop_indices=None, rng=None):
     results = []
 
-    for used_img, used_mask in zip(genImage.croped_images, genImage.croped_masks):
-        used_mask[used_mask != 0] = 255
-        filtered_mask = (Image.fromarray(used_mask.astype(np.uint8)).resize((1080, 1080))).filter(ImageFilter.SMOOTH)
+    if crop_indices is None:
+        crop_indices = range(len(genImage.croped_images))
+
+    for crop_index in crop_indices:
+        used_img, crop_mask = genImage.croped_images[crop_index], genImage.mask_stats.crop_masks[crop_index]
+        filtered_mask = (Image.fromarray(crop_mask).resize((1080, 1080))).filter(ImageFilter.SMOOTH)
 
         result = used_img.copy()
         result.paste(used_img, mask=filtered_mask)
@@ -205,7 +260,7 @@ def create_pattern_checkmarks(genImage):
         lower_bound_text = find_lower_bound_of_text(lines_sizes, line_spacing)
         result.paste(img_text, mask=img_text, box=(110, 1080 - 60 - lower_bound_text))
 
-        triple_checkmarks = create_triple_checkmarks(genImage.get_comp_colors(n_colors=3), genImage.forms_root)
+        triple_checkmarks = create_triple_checkmarks(genImage.get_comp_colors(n_colors=3), genImage.forms_root, rng)
         result.paste(triple_checkmarks, mask=triple_checkmarks, box=(884, 825))
 
         results.append(result)
@@ -213,6 +268,7 @@ def create_pattern_checkmarks(genImage):
     return results
 
 
+@photo_independent
 def create_pattern_header_at_top_checkmarks(text, forms_root, fonts_root, color='g'):
     """Args:
           text (:obj:`str`): Title text.
@@ -248,7 +304,7 @@ def create_pattern_header_at_top_checkmarks(text, forms_root, fonts_root, color=
                                                  if color == 'g' else (255, 117, 0), max_font_size=90)
         result.paste(img_text2, mask=img_text2, box=(110, lines_sizes1[0][1] + 110))
 
-    checkmarks = Image.open(os.path.join(forms_root, f'1/checkmarks_big_{color}.png'))
+    checkmarks = get_assets(forms_root).get(f'1/checkmarks_big_{color}.png')
     result.paste(checkmarks, mask=checkmarks, box=(0, 459))
 
     return [result]
@@ -258,12 +314,11 @@ def create_double_checkmarks(forms_root, color='g'):
     result = Image.new("RGBA", (129, 110))
     colors = ['lg', 'mg'] if color == 'g' else ['yel', 'mo']
 
-    cm1 = Image.open(os.path.join(forms_root, f'cm_l_{colors[0]}.png'))
-    cm1.thumbnail((69, 110))
+    assets = get_assets(forms_root)
+    cm1 = assets.get(f'cm_l_{colors[0]}.png', (69, 110), thumbnail=True)
     result.paste(cm1, mask=cm1, box=(0, 0))
 
-    cm2 = Image.open(os.path.join(forms_root, f'cm_l_{colors[1]}.png'))
-    cm2.thumbnail((69, 110))
+    cm2 = assets.get(f'cm_l_{colors[1]}.png', (69, 110), thumbnail=True)
     result.paste(cm2, mask=cm2, box=(60, 0))
 
     return result
@@ -293,7 +348,7 @@ def create_pattern_interview_text(text, forms_root, fonts_root, color='g'):
     img_text, lines_sizes1 = get_image_text(860, 912, text[1], fonts_root, color=(0, 0, 0), max_font_size=52)
     result.paste(img_text, mask=img_text, box=(110, 186))
 
-    double_checkmarks = create_double_checkmarks(color, forms_root)
+    double_checkmarks = create_double_checkmarks(forms_root, color)
 
     result.paste(double_checkmarks, mask=double_checkmarks, box=(891, 1181))
 
@@ -365,7 +420,7 @@ def get_interview_image_text(text, fonts_root, image_size=(1080, 1080), text_rel
 def gen_interview_pattern(genImage, pattern_type='round', cropped_image_index=1,
                           mask_offset='auto', text_relative_size=(0.8, 0.2),
                           text_y_offset=1.25, text_color=(255, 255, 255),
-                          max_font_size=200, text_outline_offset=10):
+                          max_font_size=200, text_outline_offset=10, rng=None):
     img = genImage.croped_images[cropped_image_index].copy()
     if pattern_type == 'round':
         # if len(genImage.faces_on_croped[cropped_image_index]) > 0:
@@ -376,9 +431,8 @@ def gen_interview_pattern(genImage, pattern_type='round', cropped_image_index=1,
         face_size = 120
         img_with_mask = get_round_mask_image(img, face_size, mask_offset)
     else:
-        mask = genImage.croped_masks[cropped_image_index].astype('uint8')
-        mask[mask > 0] = 255
-        mask = Image.fromarray(mask).resize(img.size).filter(ImageFilter.BLUR)
+        mask = Image.fromarray(genImage.mask_stats.crop_masks[cropped_image_index]).resize(img.size).filter(
+            ImageFilter.BLUR)
 
         img_with_mask = get_color_mask_image(img, mask)
 
@@ -388,13 +442,9 @@ def gen_interview_pattern(genImage, pattern_type='round', cropped_image_index=1,
 
     img_with_mask.paste(img_text, text_box, img_text)
 
-    paths = [os.path.join(genImage.forms_root, x) for x in os.listdir(genImage.forms_root)
-             if 'triangle_br' in x
-             and 's' not in x
-             and 'big' not in x
-             and os.path.isfile(os.path.join(genImage.forms_root, x))]
-
-    triangle = Image.open(paths[np.random.randint(0, len(paths))]).resize((112, 112))
+    assets = get_assets(genImage.forms_root)
+    rng = np.random if rng is None else rng
+    triangle = assets.get_triangle(rng.randint(0, len(assets.triangles)), (112, 112))
 
     triangle_box = (text_box[0], text_box[1] - 112)
 
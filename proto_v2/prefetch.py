@@ -0,0 +1,140 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import threading
+
+
+class TokenBuffer(object):
+    """Images rendered ahead for one token, generator is advanced by one thread at a time"""
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.images = deque()
+        self.rendering = False
+        self.cancelled = False
+        self.error = None
+        self.condition = threading.Condition()
+
+
+class Prefetcher(object):
+    """Renders next images of token generators in background while clients look at the current ones
+
+    Args:
+      depth: int, count of images rendered ahead for every token
+      max_workers: int, count of prefetch threads shared by all tokens
+      max_bytes: int, prefetching stops while buffered images take more memory
+    """
+
+    def __init__(self, depth=2, max_workers=2, max_bytes=256 * 1024 * 1024):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.buffers = dict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_image_size(image):
+        return image.width * image.height * len(image.getbands())
+
+    def _add_size(self, size):
+        with self._lock:
+            self.size += size
+
+    def add(self, token, generator, after=None):
+        """
+        Args:
+          token: str, session token
+          generator: iterator of images
+          after: concurrent.futures.Future, prefetching starts when it succeeds, immediately if None
+        """
+        buffer = TokenBuffer(generator)
+        self.buffers[token] = buffer
+
+        if after is None:
+            self._prefetch(buffer)
+        else:
+            after.add_done_callback(
+                lambda future: None if future.cancelled() or future.exception() is not None else self._prefetch(buffer))
+
+    def remove(self, token):
+        """Drops buffered images of token, image being rendered is dropped when it is ready"""
+        buffer = self.buffers.pop(token, None)
+        if buffer is None:
+            return
+
+        with buffer.condition:
+            buffer.cancelled = True
+            self._add_size(-sum(self.get_image_size(image) for image in buffer.images))
+            buffer.images.clear()
+            buffer.condition.notify_all()
+
+    def _prefetch(self, buffer):
+        with buffer.condition:
+            if buffer.cancelled or buffer.rendering or buffer.error is not None or \
+                    len(buffer.images) >= self.depth or self.size >= self.max_bytes:
+                return
+            buffer.rendering = True
+        self.executor.submit(self._render, buffer)
+
+    def _render(self, buffer):
+        # called by the thread which set buffer.rendering, the generator is advanced outside of the lock
+        image, error = None, None
+        try:
+            image = next(buffer.generator)
+        except Exception as e:
+            error = e
+
+        with buffer.condition:
+            buffer.rendering = False
+            if buffer.cancelled:
+                return
+            if error is not None:
+                buffer.error = error
+            else:
+                buffer.images.append(image)
+                self._add_size(self.get_image_size(image))
+            buffer.condition.notify_all()
+
+        self._prefetch(buffer)
+
+    def get(self, token, timeout=None):
+        """Returns next image of token, renders it in the calling thread if nothing is buffered or being rendered
+
+        Raises:
+          KeyError if token was not added or was removed
+          TimeoutError if image is not ready in timeout seconds
+          exception raised by the generator
+        """
+        buffer = self.buffers[token]
+
+        with buffer.condition:
+            render_here = not buffer.images and not buffer.rendering and buffer.error is None
+            if render_here:
+                buffer.rendering = True
+            with self._lock:
+                if buffer.images:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        if render_here:
+            self._render(buffer)
+
+        with buffer.condition:
+            if not buffer.condition.wait_for(lambda: buffer.images or buffer.error is not None or buffer.cancelled,
+                                             timeout):
+                raise TimeoutError(f'next image of {token} is not ready')
+            if buffer.cancelled:
+                raise KeyError(token)
+            if not buffer.images:
+                error, buffer.error = buffer.error, None
+                raise error
+            image = buffer.images.popleft()
+            self._add_size(-self.get_image_size(image))
+
+        self._prefetch(buffer)
+        return image
+
+    def get_stats(self):
+        return {'tokens': len(self.buffers), 'buffered_bytes': self.size, 'hits': self.hits, 'misses': self.misses}
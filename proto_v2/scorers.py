@@ -0,0 +1,171 @@
+import json
+import numpy as np
+import os
+import threading
+import tensorflow as tf
+
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    Interpreter = tf.lite.Interpreter
+
+SCORER_BACKENDS = ('keras', 'tflite', 'frozen_graph')
+
+
+class KerasScorer(object):
+    """Scores preprocessed batches with a Keras model"""
+
+    def __init__(self, model):
+        self.model = model
+        self.input_shape = model.input_shape
+
+    def score(self, x):
+        """
+        Args:
+          x: np.ndarray, preprocessed batch
+        Returns:
+          np.ndarray of scores
+        """
+        return np.asarray(self.model(x, training=False))[:, 0]
+
+
+class TFLiteScorer(object):
+    """Scores preprocessed batches with a TFLite model, interpreter calls are serialized"""
+
+    def __init__(self, model_path, num_threads=None):
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self.input_shape = (None,) + tuple(self._input['shape'][1:])
+        self._lock = threading.Lock()
+
+    def score(self, x):
+        with self._lock:
+            if tuple(self._input['shape']) != x.shape:
+                self.interpreter.resize_tensor_input(self._input['index'], x.shape)
+                self.interpreter.allocate_tensors()
+                self._input = self.interpreter.get_input_details()[0]
+                self._output = self.interpreter.get_output_details()[0]
+
+            scale, zero_point = self._input['quantization']
+            if scale:
+                x = np.round(x / scale + zero_point)
+            self.interpreter.set_tensor(self._input['index'], x.astype(self._input['dtype']))
+            self.interpreter.invoke()
+            y = self.interpreter.get_tensor(self._output['index']).astype(np.float32)
+
+            scale, zero_point = self._output['quantization']
+            if scale:
+                y = (y - zero_point) * scale
+
+        return y[:, 0]
+
+
+class FrozenGraphScorer(object):
+    """Scores preprocessed batches with a frozen graph exported by export_frozen_graph"""
+
+    def __init__(self, graph_path):
+        with open(graph_path + '.json') as f:
+            signature = json.load(f)
+        self.input_tensor_name = signature['input']
+        self.output_tensor_name = signature['output']
+        self.input_shape = tuple(signature['input_shape'])
+
+        self.graph = tf.Graph()
+        graph_def = tf.compat.v1.GraphDef.FromString(open(graph_path, 'rb').read())
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+
+        self.sess = tf.compat.v1.Session(graph=self.graph)
+
+    def score(self, x):
+        return self.sess.run(self.output_tensor_name,
+                             feed_dict={self.input_tensor_name: x.astype(np.float32)})[:, 0]
+
+
+def export_tflite(model, path, quantization='float16', representative_inputs=None):
+    """Exports Keras model to TFLite with post-training quantization
+    Args:
+      model: Keras model
+      path: str, output .tflite path
+      quantization: None, 'float16' or 'int8'
+      representative_inputs: np.ndarray, preprocessed batch for int8 calibration
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        if representative_inputs is None:
+            raise ValueError('int8 quantization requires representative inputs')
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([x[np.newaxis].astype(np.float32)] for x in representative_inputs)
+    elif quantization is not None:
+        raise ValueError(f'unknown quantization {quantization}')
+
+    with open(path, 'wb') as f:
+        f.write(converter.convert())
+
+
+def export_frozen_graph(model, path):
+    """Exports Keras model to a frozen graph, tensor names and input shape are saved to path + '.json'"""
+    from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+
+    function = tf.function(lambda x: model(x, training=False)).get_concrete_function(
+        tf.TensorSpec(model.inputs[0].shape, model.inputs[0].dtype))
+    frozen_function = convert_variables_to_constants_v2(function)
+
+    with open(path, 'wb') as f:
+        f.write(frozen_function.graph.as_graph_def().SerializeToString())
+    with open(path + '.json', 'w') as f:
+        json.dump({'input': frozen_function.inputs[0].name,
+                   'output': frozen_function.outputs[0].name,
+                   'input_shape': list(model.input_shape)}, f)
+
+
+def load_scorer(backend, model, path=None, quantization='float16', representative_inputs=None):
+    """Returns scorer for the given backend, exports Keras model if the exported one doesn't exist yet
+    Args:
+      backend: str, one of SCORER_BACKENDS
+      model: Keras model
+      path: str, path of exported model, required for all backends except 'keras'
+      quantization: quantization used for TFLite export
+      representative_inputs: np.ndarray, preprocessed batch for int8 calibration
+    """
+    if backend == 'keras':
+        return KerasScorer(model)
+    if backend not in SCORER_BACKENDS:
+        raise ValueError(f'unknown scorer backend {backend}, available backends: {SCORER_BACKENDS}')
+    if path is None:
+        raise ValueError(f'{backend} scorer requires a model path')
+
+    if backend == 'tflite':
+        if not os.path.exists(path):
+            export_tflite(model, path, quantization, representative_inputs)
+        return TFLiteScorer(path)
+    else:
+        if not os.path.exists(path):
+            export_frozen_graph(model, path)
+        return FrozenGraphScorer(path)
+
+
+def measure_agreement(reference, scorer, x, threshold=0.6):
+    """Compares scorer with reference scorer on the same inputs
+    Args:
+      reference: KerasScorer or any other scorer
+      scorer: scorer to check
+      x: np.ndarray, preprocessed batch
+      threshold: float, decision threshold
+    Returns:
+      dict with mean and max absolute score difference and share of equal threshold decisions
+    """
+    reference_scores = reference.score(x)
+    scores = scorer.score(x)
+    diff = np.abs(reference_scores - scores)
+
+    return {'samples': int(len(x)),
+            'mean_abs_diff': float(diff.mean()),
+            'max_abs_diff': float(diff.max()),
+            'decision_agreement': float(np.mean((reference_scores >= threshold) == (scores >= threshold)))}
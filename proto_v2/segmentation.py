@@ -1,5 +1,10 @@
+from concurrent.futures import Future
 from io import BytesIO
 import numpy as np
+import os
+import queue
+import threading
+import time
 from PIL import Image
 import tensorflow as tf
 
@@ -10,10 +15,13 @@ class DeepLabModel(object):
     INPUT_TENSOR_NAME = 'ImageTensor:0'
     OUTPUT_TENSOR_NAME = 'SemanticPredictions:0'
     INPUT_SIZE = 513
+    # DeepLab pads inputs with the mean pixel inside the graph, batched images are padded the same way
+    MEAN_PIXEL = 127.5
     FROZEN_GRAPH_NAME = 'frozen_inference_graph'
 
     def __init__(self, tarball_path):
         """Creates and loads pretrained deeplab model."""
+        self.model_id = os.path.basename(os.path.normpath(tarball_path))
         self.graph = tf.Graph()
 
         graph_def = None
@@ -26,6 +34,36 @@ class DeepLabModel(object):
             tf.import_graph_def(graph_def, name='')
 
         self.sess = tf.compat.v1.Session(graph=self.graph)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+        # exported DeepLab graphs usually have a fixed batch size of one
+        input_shape = self.graph.get_tensor_by_name(self.INPUT_TENSOR_NAME).shape
+        self.supports_batching = input_shape.rank is None or input_shape[0] is None or input_shape[0] > 1
+
+    def in_flight(self):
+        """Returns number of images being segmented"""
+        return self._in_flight
+
+    def _add_in_flight(self, count):
+        with self._lock:
+            self._in_flight += count
+
+    def preprocess(self, image):
+        """Resizes image so that its largest side equals INPUT_SIZE
+
+        Args:
+          image: A PIL.Image object, raw input image.
+
+        Returns:
+          RGB image resized from original input image.
+        """
+        width, height = image.size
+        resize_ratio = 1.0 * self.INPUT_SIZE / max(width, height)
+        target_size = (int(resize_ratio * width), int(resize_ratio * height))
+        if image.mode == 'RGB' and image.size == target_size:
+            return image
+        return image.convert('RGB').resize(target_size, Image.ANTIALIAS)
 
     def run(self, image):
         """Runs inference on a single image.
@@ -38,60 +76,292 @@ class DeepLabModel(object):
           seg_map: Segmentation map of `resized_image`.
         """
 
-        width, height = image.size
-        resize_ratio = 1.0 * self.INPUT_SIZE / max(width, height)
-        target_size = (int(resize_ratio * width), int(resize_ratio * height))
-        resized_image = image.convert('RGB').resize(target_size, Image.ANTIALIAS)
-        batch_seg_map = self.sess.run(
-            self.OUTPUT_TENSOR_NAME,
-            feed_dict={self.INPUT_TENSOR_NAME: [np.asarray(resized_image)]})
-        seg_map = batch_seg_map[0]
+        return self.run_batch([image])[0]
+
+    def run_batch(self, images):
+        """Runs inference on several images with a single session call.
+
+        Images are padded to INPUT_SIZE x INPUT_SIZE with MEAN_PIXEL like the graph pads a single image,
+        every segmentation map is cropped back to the size of its image. If the graph has a fixed batch size of one,
+        images are fed one by one.
+
+        Args:
+          images: list of PIL.Image objects, raw input images.
+
+        Returns:
+          list of (resized_image, seg_map) tuples in the order of `images`.
+        """
+        self._add_in_flight(len(images))
+        try:
+            return self._run_batch(images)
+        finally:
+            self._add_in_flight(-len(images))
+
+    def _run_batch(self, images):
+        resized_images = [self.preprocess(image) for image in images]
+
+        if len(resized_images) == 1 or not self.supports_batching:
+            return [(resized_image, self.sess.run(
+                self.OUTPUT_TENSOR_NAME,
+                feed_dict={self.INPUT_TENSOR_NAME: [np.asarray(resized_image)]})[0])
+                for resized_image in resized_images]
+
+        # ImageTensor is uint8, so the nearest integer to the mean pixel is used
+        batch = np.full((len(resized_images), self.INPUT_SIZE, self.INPUT_SIZE, 3), int(self.MEAN_PIXEL + 0.5),
+                        dtype=np.uint8)
+        for i, resized_image in enumerate(resized_images):
+            batch[i, :resized_image.size[1], :resized_image.size[0]] = np.asarray(resized_image)
+
+        batch_seg_map = self.sess.run(self.OUTPUT_TENSOR_NAME, feed_dict={self.INPUT_TENSOR_NAME: batch})
+
+        return [(resized_image, batch_seg_map[i, :resized_image.size[1], :resized_image.size[0]])
+                for i, resized_image in enumerate(resized_images)]
+
+
+class BatchedDeepLabModel(object):
+    """Collects concurrent inference requests into batches for DeepLabModel.
+
+    Requests arriving within `batch_window` seconds after the first one (up to `max_batch_size` images)
+    are executed with a single DeepLabModel.run_batch call in a background thread.
+    """
+
+    def __init__(self, model, max_batch_size=8, batch_window=0.02):
+        self.model = model
+        self.model_id = model.model_id
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self._queue = queue.Queue()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+        self._worker = threading.Thread(target=self._serve, daemon=True)
+        self._worker.start()
+
+    def in_flight(self):
+        """Returns number of images waiting for inference or being segmented"""
+        return self._in_flight
+
+    def _add_in_flight(self, count):
+        with self._lock:
+            self._in_flight += count
+
+    def run(self, image):
+        """Runs inference on a single image, see DeepLabModel.run"""
+        future = Future()
+        self._add_in_flight(1)
+        self._queue.put((image, future))
+        return future.result()
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_window
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _serve(self):
+        while True:
+            batch = self._collect_batch()
+            images = [image for image, _ in batch]
+            futures = [future for _, future in batch]
+
+            try:
+                results = self.model.run_batch(images)
+            except Exception as e:
+                self._add_in_flight(-len(futures))
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            self._add_in_flight(-len(futures))
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+
+def batch_requests(model, max_batch_size=8, batch_window=0.02):
+    """Returns BatchedDeepLabModel collecting requests to model if its graph accepts batches
+
+    Graphs with a fixed batch size of one gain nothing from batching, so such models are returned as is
+    and run in the calling threads.
+    """
+    if not model.supports_batching:
+        return model
+    return BatchedDeepLabModel(model, max_batch_size=max_batch_size, batch_window=batch_window)
+
+
+class SegmentationBackends(object):
+    """Registry of segmentation models by quality tier
+
+    Args:
+      backends: dict, tier name -> model, e.g. {'fast': ..., 'accurate': ...}
+      default: str, tier used when none is requested
+      fallback: str, tier to use when the requested backend is overloaded, disabled if None
+      fallback_in_flight: int, count of images queued or being segmented by the requested backend
+        to start falling back at
+    """
 
-        return resized_image, seg_map
+    def __init__(self, backends, default, fallback=None, fallback_in_flight=None):
+        if default not in backends or (fallback is not None and fallback not in backends):
+            raise ValueError(f'unknown default or fallback tier, available tiers: {list(backends)}')
+
+        self.backends = backends
+        self.default = default
+        self.fallback = fallback
+        self.fallback_in_flight = fallback_in_flight
+
+    def tiers(self):
+        return list(self.backends)
+
+    def get(self, tier=None):
+        """Returns segmentation model for the given tier
+
+        Raises:
+          ValueError if tier is unknown
+        """
+        if tier is None:
+            tier = self.default
+        if tier not in self.backends:
+            raise ValueError(f'unknown segmentation tier {tier}, available tiers: {self.tiers()}')
+
+        model = self.backends[tier]
+        if (self.fallback is not None and self.fallback_in_flight is not None and tier != self.fallback and
+                model.in_flight() >= self.fallback_in_flight):
+            return self.backends[self.fallback]
+
+        return model
+
+    def get_by_id(self, model_id):
+        """Returns segmentation model with the given model_id, the one get has chosen before
+
+        Raises:
+          ValueError if no tier has such model
+        """
+        for model in self.backends.values():
+            if model.model_id == model_id:
+                return model
+        raise ValueError(f'unknown segmentation model {model_id}')
 
 
-def seg(image_bytes, model):
+def seg(image, model):
     """remove background from image
     Parameters:
-      image_bytes
+      image: image bytes or PIL.Image, images resized to model input size are not resized again
       model
     Return:
       Resized Image
       Mask
       Segmented Image
     """
-    if image_bytes is None:
+    if image is None:
         raise RuntimeError("Bad parameters. Please specify input file path and output file path")
 
-    def run_visualization(image_bytes):
+    def run_visualization(image):
         """Inferences DeepLab model and visualizes result."""
-        try:
-            orignal_im = Image.open(BytesIO(image_bytes))
-        except IOError:
-            print('Cannot retrieve image.')
-            return
+        if isinstance(image, Image.Image):
+            orignal_im = image
+        else:
+            try:
+                orignal_im = Image.open(BytesIO(image))
+            except IOError:
+                print('Cannot retrieve image.')
+                return
 
         resized_im, seg_map = model.run(orignal_im)
 
         return orignal_im, seg_map
 
-    visualization = run_visualization(image_bytes)
+    visualization = run_visualization(image)
 
     return visualization
 
 
+class EmptyAreaFinder(object):
+    """Finds the largest rectangles filled with the given value in a matrix.
+
+    Keeps per row histograms of consecutive matching cells together with left and right bounds of the
+    rectangle each column can span, so every row is processed with array operations. When a rectangle
+    is filled, only rows starting from its top are recomputed.
+    """
+
+    def __init__(self, mat, value=0):
+        self.free = np.asarray(mat) == value
+        rows, cols = self.free.shape
+        self._columns = np.arange(cols)
+        self._heights = np.zeros((rows, cols), dtype=np.int32)
+        self._lefts = np.zeros((rows, cols), dtype=np.int32)
+        self._rights = np.full((rows, cols), cols, dtype=np.int32)
+        self._best_areas = np.zeros(rows, dtype=np.int64)
+        self._best_columns = np.zeros(rows, dtype=np.int32)
+        self._update_rows(0)
+
+    def _update_rows(self, start_row):
+        """Recomputes histograms and best rectangles for rows starting from start_row"""
+        rows, cols = self.free.shape
+        if start_row > 0:
+            height = self._heights[start_row - 1]
+            left = self._lefts[start_row - 1]
+            right = self._rights[start_row - 1]
+        else:
+            height = np.zeros(cols, dtype=np.int32)
+            left = np.zeros(cols, dtype=np.int32)
+            right = np.full(cols, cols, dtype=np.int32)
+
+        for row in range(start_row, rows):
+            free = self.free[row]
+            run_left = np.maximum.accumulate(np.where(free, 0, self._columns + 1))
+            run_right = np.minimum.accumulate(np.where(free, cols, self._columns)[::-1])[::-1]
+
+            height = np.where(free, height + 1, 0)
+            left = np.where(free, np.maximum(left, run_left), 0)
+            right = np.where(free, np.minimum(right, run_right), cols)
+
+            self._heights[row] = height
+            self._lefts[row] = left
+            self._rights[row] = right
+
+            areas = height * (right - left)
+            column = int(areas.argmax()) if cols else 0
+            self._best_columns[row] = column
+            self._best_areas[row] = areas[column] if cols else 0
+
+    def largest(self):
+        """Returns (height, width), (top row, left column) of the largest rectangle"""
+        if not self._best_areas.size:
+            return (0, 0), (0, 0)
+
+        row = int(self._best_areas.argmax())
+        if self._best_areas[row] == 0:
+            return (0, 0), (0, 0)
+
+        column = self._best_columns[row]
+        height = int(self._heights[row, column])
+        left, right = int(self._lefts[row, column]), int(self._rights[row, column])
+
+        return (height, right - left), (row - height + 1, left)
+
+    def fill(self, pos, size):
+        """Marks rectangle as occupied
+
+        Args:
+          pos: tuple, (top row, left column)
+          size: tuple, (height, width)
+        """
+        self.free[pos[0]:pos[0] + size[0], pos[1]:pos[1] + size[1]] = False
+        self._update_rows(pos[0])
+
+
 # returns height, width, and position of the top left corner of the largest
 #  rectangle with the given value in mat
 def max_size(mat, value=0):
-    it = iter(mat)
-    hist = [(el == value) for el in next(it, [])]
-    max_size_start, start_row = max_rectangle_size(hist), 0
-    for i, row in enumerate(it):
-        hist = [(1 + h) if el == value else 0 for h, el in zip(hist, row)]
-        mss = max_rectangle_size(hist)
-        if area(mss) > area(max_size_start):
-            max_size_start, start_row = mss, i + 2 - mss[0]
-    return max_size_start[:2], (start_row, max_size_start[2])
+    return EmptyAreaFinder(mat, value).largest()
 
 
 # returns height, width, and start column of the largest rectangle that
@@ -154,22 +424,20 @@ def get_empty_areas(mask, areas_count=1, scale=1):
         list: ((pos_x, pos_y), (size_x, size_y)).
     """
 
-    img = mask.copy()
+    finder = EmptyAreaFinder(mask)
     result = []
 
     def scale_and_int(n):
         return int(n * scale)
 
     for i in range(areas_count):
-        size, pos = max_size(img)
+        size, pos = finder.largest()
         scaled_size, scaled_pos = list(map(scale_and_int, size)), list(map(scale_and_int, pos))
 
         if scaled_size[0] == 0 or scaled_size[1] == 0:
             break
 
-        for x in range(pos[1], pos[1] + size[1]):
-            for y in range(pos[0], pos[0] + size[0]):
-                img[y, x] = 1
+        finder.fill(pos, size)
 
         if scaled_size[0] < 100 or scaled_size[1] < 100:
             continue
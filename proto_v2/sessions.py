@@ -0,0 +1,213 @@
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+
+SESSION_FIELDS = ('token', 'text', 'seg_model', 'seed', 'next_index', 'created', 'last_access')
+
+
+class SessionStore(ABC):
+    """Storage of generation sessions shared by all workers serving tokens
+
+    Session is a dict with SESSION_FIELDS, uploaded image bytes and serialized analysis are stored
+    separately because they are large. seg_model is model_id of the segmentation model chosen for the session.
+    """
+
+    @abstractmethod
+    def create(self, token, image_bytes, text, seg_model, seed):
+        pass
+
+    @abstractmethod
+    def get(self, token):
+        """Returns session dict or None if token doesn't exist"""
+        pass
+
+    @abstractmethod
+    def get_image(self, token):
+        pass
+
+    @abstractmethod
+    def set_analysis(self, token, analysis):
+        """Stores serialized image analysis, bytes"""
+        pass
+
+    @abstractmethod
+    def get_analysis(self, token):
+        """Returns serialized image analysis or None if it wasn't stored yet"""
+        pass
+
+    @abstractmethod
+    def touch(self, token):
+        """Prolongs session lifetime"""
+        pass
+
+    @abstractmethod
+    def advance_index(self, token, index):
+        """Atomically moves next_index of session from index to index + 1
+
+        Returns:
+          False if token doesn't exist or another worker has already served index
+        """
+        pass
+
+    @abstractmethod
+    def remove(self, token):
+        pass
+
+    @abstractmethod
+    def tokens(self):
+        pass
+
+    @abstractmethod
+    def prune(self, max_age, max_count):
+        """Removes sessions not touched for max_age seconds and the least recently touched ones over max_count
+
+        Returns:
+          list of removed tokens
+        """
+        pass
+
+
+class InMemorySessionStore(SessionStore):
+    """Session store of a single process"""
+
+    def __init__(self):
+        self.sessions = dict()
+        self._lock = threading.Lock()
+
+    def create(self, token, image_bytes, text, seg_model, seed):
+        now = time.time()
+        with self._lock:
+            self.sessions[token] = {'token': token, 'text': text, 'seg_model': seg_model, 'seed': seed,
+                                    'next_index': 0, 'created': now, 'last_access': now, 'image': image_bytes,
+                                    'analysis': None}
+
+    def get(self, token):
+        with self._lock:
+            session = self.sessions.get(token)
+            return None if session is None else {field: session[field] for field in SESSION_FIELDS}
+
+    def get_image(self, token):
+        with self._lock:
+            return self.sessions[token]['image'] if token in self.sessions else None
+
+    def set_analysis(self, token, analysis):
+        with self._lock:
+            if token in self.sessions:
+                self.sessions[token]['analysis'] = analysis
+
+    def get_analysis(self, token):
+        with self._lock:
+            return self.sessions[token]['analysis'] if token in self.sessions else None
+
+    def touch(self, token):
+        with self._lock:
+            if token in self.sessions:
+                self.sessions[token]['last_access'] = time.time()
+
+    def advance_index(self, token, index):
+        with self._lock:
+            if token not in self.sessions or self.sessions[token]['next_index'] != index:
+                return False
+            self.sessions[token]['next_index'] = index + 1
+            return True
+
+    def remove(self, token):
+        with self._lock:
+            self.sessions.pop(token, None)
+
+    def tokens(self):
+        with self._lock:
+            return list(self.sessions)
+
+    def prune(self, max_age, max_count):
+        removed = []
+        with self._lock:
+            by_access = sorted(self.sessions.values(), key=lambda session: session['last_access'], reverse=True)
+            for index, session in enumerate(by_access):
+                if index >= max_count or time.time() - session['last_access'] > max_age:
+                    removed.append(session['token'])
+                    del self.sessions[session['token']]
+        return removed
+
+
+class SQLiteSessionStore(SessionStore):
+    """Session store in a local SQLite database shared by all worker processes on the host
+
+    Args:
+      path: str, database file
+      timeout: float, seconds to wait for locks held by other processes
+    """
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                               'token TEXT PRIMARY KEY, text TEXT, seg_model TEXT, seed INTEGER, '
+                               'next_index INTEGER NOT NULL DEFAULT 0, created REAL, last_access REAL, '
+                               'image BLOB, analysis BLOB)')
+
+    def _connect(self):
+        """Returns connection of the calling thread, sqlite connections can't be shared between threads"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def create(self, token, image_bytes, text, seg_model, seed):
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute('INSERT INTO sessions (token, text, seg_model, seed, created, last_access, image) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?)', (token, text, seg_model, seed, now, now, image_bytes))
+
+    def get(self, token):
+        row = self._connect().execute(f'SELECT {", ".join(SESSION_FIELDS)} FROM sessions WHERE token = ?',
+                                      (token, )).fetchone()
+        return None if row is None else dict(zip(SESSION_FIELDS, row))
+
+    def _get_blob(self, token, column):
+        row = self._connect().execute(f'SELECT {column} FROM sessions WHERE token = ?', (token, )).fetchone()
+        return None if row is None or row[0] is None else bytes(row[0])
+
+    def get_image(self, token):
+        return self._get_blob(token, 'image')
+
+    def set_analysis(self, token, analysis):
+        with self._connect() as connection:
+            connection.execute('UPDATE sessions SET analysis = ? WHERE token = ?', (analysis, token))
+
+    def get_analysis(self, token):
+        return self._get_blob(token, 'analysis')
+
+    def touch(self, token):
+        with self._connect() as connection:
+            connection.execute('UPDATE sessions SET last_access = ? WHERE token = ?', (time.time(), token))
+
+    def advance_index(self, token, index):
+        with self._connect() as connection:
+            # compare and set in one statement, so only one of concurrent workers advances index
+            cursor = connection.execute('UPDATE sessions SET next_index = ? WHERE token = ? AND next_index = ?',
+                                        (index + 1, token, index))
+        return cursor.rowcount == 1
+
+    def remove(self, token):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM sessions WHERE token = ?', (token, ))
+
+    def tokens(self):
+        return [row[0] for row in self._connect().execute('SELECT token FROM sessions')]
+
+    def prune(self, max_age, max_count):
+        connection = self._connect()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            removed = [row[0] for row in connection.execute(
+                'SELECT token FROM sessions WHERE last_access < ? OR token NOT IN '
+                '(SELECT token FROM sessions ORDER BY last_access DESC LIMIT ?)', (time.time() - max_age, max_count))]
+            connection.executemany('DELETE FROM sessions WHERE token = ?', [(token, ) for token in removed])
+        return removed
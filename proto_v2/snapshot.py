@@ -0,0 +1,50 @@
+from io import BytesIO
+import json
+import numpy as np
+import zipfile
+
+SNAPSHOT_VERSION = 1
+
+
+def dump(header, arrays):
+    """Packs JSON serializable header and arrays into npz bytes
+    Args:
+      header: dict, small metadata, version is added to it
+      arrays: dict of np.ndarray
+    Returns:
+      bytes
+    """
+    header = json.dumps(dict(header, version=SNAPSHOT_VERSION)).encode('utf8')
+    buffer = BytesIO()
+    np.savez_compressed(buffer, header=np.frombuffer(header, dtype=np.uint8), **arrays)
+    return buffer.getvalue()
+
+
+def load(data):
+    """Unpacks bytes made by dump
+
+    Returns:
+      header dict, dict of arrays
+    Raises:
+      ValueError if data is not a snapshot or its version is not supported
+    """
+    try:
+        with np.load(BytesIO(data)) as npz:
+            header = json.loads(npz['header'].tobytes().decode('utf8'))
+            arrays = {name: npz[name] for name in npz.files if name != 'header'}
+    except (IOError, KeyError, ValueError, zipfile.BadZipFile) as e:
+        raise ValueError(f'invalid snapshot: {e}')
+
+    if header.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f'unsupported snapshot version {header.get("version")}, expected {SNAPSHOT_VERSION}')
+    return header, arrays
+
+
+def pack_mask(mask):
+    """Packs nonzero pixels of mask into bits, shape has to be stored separately"""
+    return np.packbits(np.asarray(mask) != 0)
+
+
+def unpack_mask(packed, shape):
+    """Returns uint8 mask with 1 for nonzero pixels of the packed one"""
+    return np.unpackbits(packed, count=int(np.prod(shape))).reshape(shape)